@@ -0,0 +1,90 @@
+"""Measure DiffusionModel training speed and peak memory per attention type of the U-Net.\n
+Every attention type runs in its own process, as peak memory is measured per process. The U-Net has attention
+on every level, starting at the full input resolution, where 'full' attention scores take (H*W)^2 memory.\n
+Run from the Python directory:
+`python -m benchmarks.attention_memory --shape 64 64 --types full window axial chunked`"""
+
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import time
+import numpy as np
+
+
+def run_configuration(attn_type: str, shape: tuple[int, ...], latent_dims: int, batch_size: int,
+                      steps: int, warmup_steps: int, window_size: int, chunk_size: int) -> dict:
+    import keras # pylint: disable=import-outside-toplevel
+    from voxelnn.diffusion import unet_builder # pylint: disable=import-outside-toplevel
+    from voxelnn.diffusion.diffusion_model import DiffusionModel # pylint: disable=import-outside-toplevel
+
+    layer_units = [32, 64, 96]
+    unet = unet_builder.build_model(input_shape=shape,
+                                    latent_dims=latent_dims,
+                                    layer_units=layer_units,
+                                    layer_attn_heads=[1, 1, 2],
+                                    layer_res_blocks=[1, 1, 1],
+                                    norm_groups=4,
+                                    first_conv_channels=32,
+                                    time_embedding_dims=32,
+                                    max_time_emb_frequency=200.0,
+                                    layer_attn_types=[attn_type] * len(layer_units),
+                                    attn_window_size=window_size,
+                                    attn_chunk_size=chunk_size)
+    diffusion_model = DiffusionModel(unet)
+    diffusion_model.compile(optimizer=keras.optimizers.AdamW(learning_rate=1e-3, weight_decay=1e-4),
+                            loss=keras.losses.mean_absolute_error)
+
+    data = np.random.default_rng(0).normal(size=(batch_size * (steps + warmup_steps), *shape, latent_dims))
+    data = data.astype(np.float32)
+    diffusion_model.learn_data_distribution(data)
+
+    diffusion_model.fit(data[:batch_size * warmup_steps], batch_size=batch_size, epochs=1, verbose=0)
+    start = time.perf_counter()
+    diffusion_model.fit(data[batch_size * warmup_steps:], batch_size=batch_size, epochs=1, verbose=0)
+    seconds = time.perf_counter() - start
+
+    return {
+        'attention': attn_type,
+        'parameters': unet.count_params(),
+        'steps_per_second': steps / seconds,
+        'peak_memory_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def _main():
+    parser = argparse.ArgumentParser(description='DiffusionModel training speed and peak memory per attention type.')
+    parser.add_argument('--types', nargs='+', default=['full', 'window', 'axial', 'chunked'])
+    parser.add_argument('--shape', nargs='+', type=int, default=[64, 64])
+    parser.add_argument('--latent-dims', type=int, default=4)
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--steps', type=int, default=10)
+    parser.add_argument('--warmup-steps', type=int, default=2)
+    parser.add_argument('--window-size', type=int, default=8)
+    parser.add_argument('--chunk-size', type=int, default=1024)
+    parser.add_argument('--configuration', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.configuration is not None:
+        result = run_configuration(args.configuration, tuple(args.shape), args.latent_dims, args.batch_size,
+                                   args.steps, args.warmup_steps, args.window_size, args.chunk_size)
+        print(json.dumps(result))
+        return
+
+    common = ['--shape', *map(str, args.shape), '--latent-dims', str(args.latent_dims),
+              '--batch-size', str(args.batch_size), '--steps', str(args.steps),
+              '--warmup-steps', str(args.warmup_steps), '--window-size', str(args.window_size),
+              '--chunk-size', str(args.chunk_size)]
+    print(f"{'attention':<10}{'params':>9}{'steps/s':>10}{'peak MB':>10}")
+    for attn_type in args.types:
+        output = subprocess.run([sys.executable, '-m', 'benchmarks.attention_memory', *common,
+                                 '--configuration', attn_type],
+                                capture_output=True, text=True, check=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print(f"{attn_type:<10}{result['parameters']:>9}{result['steps_per_second']:>10.2f}"
+              f"{result['peak_memory_mb']:>10.0f}", flush=True)
+
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,106 @@
+"""Measure the import time of the headless entry points with `python -X importtime`.\n
+Every entry point is imported in a fresh process. Besides the total, the time spent importing TensorFlow
+(through Keras, for most modules) is reported, and an entry point importing a visualization library fails
+the run. With --baseline, totals are compared with an earlier --output, and a run more than --tolerance times
+slower than the baseline fails as well.\n
+Run from the Python directory:
+`python -m benchmarks.import_time --output import_time.json`"""
+
+import argparse
+import json
+import subprocess
+import sys
+
+ENTRY_POINTS = [
+    'voxelnn',
+    'voxelnn.__main__',
+    'voxelnn.dataset_storage',
+    'voxelnn.dataset_manipulation',
+    'voxelnn.model_storage',
+    'voxelnn.tflite_generator',
+    'voxelnn.entry_writer',
+    'voxelnn.jupyter_tools',
+    'voxelnn.input_pipeline',
+    'voxelnn.diffusion.diffusion_model',
+    'voxelnn.generation_server',
+    'voxelnn.export',
+]
+# entry points, which have to work without TensorFlow installed
+TENSORFLOW_FREE = {'voxelnn', 'voxelnn.__main__', 'voxelnn.dataset_storage', 'voxelnn.dataset_manipulation',
+                   'voxelnn.model_storage', 'voxelnn.tflite_generator', 'voxelnn.entry_writer',
+                   'voxelnn.jupyter_tools'}
+# the notebook's plotting and widget libraries; TensorFlow loads IPython itself
+VISUALIZATION_MODULES = {'matplotlib', 'seaborn', 'ipywidgets'}
+
+
+def measure(module: str, repeats: int) -> dict:
+    """Returns the median total import time of module and of tensorflow in ms, and the visualization modules
+    it imported."""
+    totals, tensorflow_times = [], []
+    # failed imports are listed by importtime too, loaded modules are taken from sys.modules
+    code = f'import sys, {module}; print(sorted({{name.split(".")[0] for name in sys.modules}}))'
+    for _ in range(repeats):
+        process = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                                 capture_output=True, text=True, check=True)
+        cumulative = {}
+        for line in process.stderr.splitlines():
+            if not line.startswith('import time:') or 'cumulative' in line:
+                continue
+            _, cumulative_us, name = line[len('import time:'):].split('|')
+            cumulative[name.strip()] = int(cumulative_us)
+        loaded = set(json.loads(process.stdout.strip().splitlines()[-1].replace("'", '"')))
+        totals.append(cumulative[module] / 1000)
+        tensorflow_times.append(cumulative.get('tensorflow', 0) / 1000)
+
+    return {
+        'module': module,
+        'total_ms': sorted(totals)[len(totals) // 2],
+        'tensorflow_ms': sorted(tensorflow_times)[len(tensorflow_times) // 2],
+        'visualization': sorted(loaded & VISUALIZATION_MODULES),
+        'tensorflow_loaded': 'tensorflow' in loaded,
+    }
+
+
+def _main():
+    parser = argparse.ArgumentParser(description='Import time of the headless entry points.')
+    parser.add_argument('--modules', nargs='+', default=ENTRY_POINTS)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--output', default=None, help='write the results to this JSON file')
+    parser.add_argument('--baseline', default=None, help='compare with results of an earlier run')
+    parser.add_argument('--tolerance', type=float, default=1.5)
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.baseline is not None:
+        with open(args.baseline, 'r', encoding='utf-8') as file:
+            baseline = {result['module']: result for result in json.load(file)}
+
+    failures = []
+    results = []
+    print(f"{'module':<36}{'total ms':>10}{'tf ms':>10}{'baseline':>10}  problems")
+    for module in args.modules:
+        result = measure(module, args.repeats)
+        results.append(result)
+        problems = []
+        if result['visualization']:
+            problems.append(f"imports {', '.join(result['visualization'])}")
+        if module in TENSORFLOW_FREE and result['tensorflow_loaded']:
+            problems.append('imports tensorflow')
+        baseline_ms = baseline[module]['total_ms'] if module in baseline else None
+        if baseline_ms is not None and result['total_ms'] > baseline_ms * args.tolerance:
+            problems.append(f'{result["total_ms"] / baseline_ms:.1f}x slower than the baseline')
+        failures.extend(f'{module}: {problem}' for problem in problems)
+
+        baseline_text = f'{baseline_ms:>10.0f}' if baseline_ms is not None else f"{'-':>10}"
+        print(f"{module:<36}{result['total_ms']:>10.0f}{result['tensorflow_ms']:>10.0f}{baseline_text}  "
+              f"{'; '.join(problems)}", flush=True)
+
+    if args.output is not None:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=2)
+    if failures:
+        sys.exit('Import time check failed:\n' + '\n'.join(failures))
+
+
+if __name__ == '__main__':
+    _main()
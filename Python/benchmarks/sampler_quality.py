@@ -0,0 +1,69 @@
+"""Compare sampling methods by how well they reproduce a many-step DDIM reference in few steps.\n
+Every method starts from the same initial noise as the reference (same seed and element count),
+the generated latents are decoded and the share of blocks equal to the decoded reference is reported.
+Stochastic methods (DDPM, EULER-ANCESTRAL) follow a different trajectory, so their agreement is only
+a rough indication of quality.\n
+Run from the Python directory:
+`python -m benchmarks.sampler_quality path/to/diffusion.keras path/to/decoder.keras`"""
+
+import argparse
+import time
+import keras
+import numpy as np
+from voxelnn.coding.decoding import decode_to_blocks
+# register the custom objects needed to load the models
+import voxelnn.coding.custom_layers # pylint: disable=unused-import
+import voxelnn.diffusion.custom_layers # pylint: disable=unused-import
+import voxelnn.diffusion.diffusion_model # pylint: disable=unused-import
+
+# network evaluations per diffusion step
+_EVALUATIONS_PER_STEP = {'HEUN': 2}
+
+
+def run(diffusion_model, decoder, methods: list[str], steps: list[int], reference_steps: int,
+        element_count: int, seed: int) -> list[tuple[str, int, int, float, float]]:
+    """Returns rows of (method, steps, network evaluations, block accuracy, seconds per batch)."""
+    reference = diffusion_model.generate(diffusion_steps=reference_steps, element_count=element_count, seed=seed,
+                                         method='DDIM', history='none')[0]
+    reference_blocks = decode_to_blocks(decoder, reference)
+
+    rows = []
+    for method in methods:
+        for step_count in steps:
+            # the first call traces the sampler
+            diffusion_model.generate(diffusion_steps=step_count, element_count=element_count, seed=seed,
+                                     method=method, history='none')
+            start = time.perf_counter()
+            pred_data = diffusion_model.generate(diffusion_steps=step_count, element_count=element_count, seed=seed,
+                                                 method=method, history='none')[0]
+            seconds = time.perf_counter() - start
+            accuracy = float(np.mean(decode_to_blocks(decoder, pred_data) == reference_blocks))
+            evaluations = step_count * _EVALUATIONS_PER_STEP.get(method, 1)
+            rows.append((method, step_count, evaluations, accuracy, seconds))
+    return rows
+
+
+def _main():
+    parser = argparse.ArgumentParser(description='Block accuracy of sampling methods against a DDIM reference.')
+    parser.add_argument('diffusion_model', help='saved DiffusionModel (.keras)')
+    parser.add_argument('decoder', help='saved decoder (.keras)')
+    parser.add_argument('--methods', nargs='+', default=['DDIM', 'DDPM', 'DPM++2M', 'DPM++3M', 'HEUN', 'EULER-ANCESTRAL'])
+    parser.add_argument('--steps', nargs='+', type=int, default=[5, 10, 15, 25, 50])
+    parser.add_argument('--reference-steps', type=int, default=500)
+    parser.add_argument('--element-count', type=int, default=16)
+    parser.add_argument('--seed', type=int, default=1234)
+    args = parser.parse_args()
+
+    diffusion_model = keras.models.load_model(args.diffusion_model)
+    decoder = keras.models.load_model(args.decoder)
+    rows = run(diffusion_model, decoder, args.methods, args.steps, args.reference_steps,
+               args.element_count, args.seed)
+
+    print(f'Reference: DDIM, {args.reference_steps} steps, {args.element_count} elements, seed {args.seed}')
+    print(f"{'method':<16}{'steps':>6}{'evals':>7}{'accuracy':>10}{'seconds':>9}")
+    for method, step_count, evaluations, accuracy, seconds in rows:
+        print(f'{method:<16}{step_count:>6}{evaluations:>7}{accuracy:>10.4f}{seconds:>9.3f}')
+
+
+if __name__ == '__main__':
+    _main()
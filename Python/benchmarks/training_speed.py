@@ -0,0 +1,90 @@
+"""Measure DiffusionModel training speed and memory per precision and XLA compilation.\n
+Every configuration runs in its own process, as the dtype policy is global and peak memory
+is measured per process. The U-Net is the 4-level one from the notebook.\n
+Run from the Python directory:
+`python -m benchmarks.training_speed --precisions float32 mixed_bfloat16 --jit-compile 0 1`"""
+
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import time
+import numpy as np
+
+
+def run_configuration(precision: str, jit_compile: bool, shape: tuple[int, ...], latent_dims: int,
+                      batch_size: int, steps: int, warmup_steps: int) -> dict:
+    import keras # pylint: disable=import-outside-toplevel
+    from voxelnn import tensorflow_tools # pylint: disable=import-outside-toplevel
+    from voxelnn.diffusion import unet_builder # pylint: disable=import-outside-toplevel
+    from voxelnn.diffusion.diffusion_model import DiffusionModel # pylint: disable=import-outside-toplevel
+
+    tensorflow_tools.set_precision(precision)
+    unet = unet_builder.build_model(input_shape=shape,
+                                    latent_dims=latent_dims,
+                                    layer_units=[a * 32 for a in [1, 2, 3, 4]],
+                                    layer_attn_heads=[0, 1, 2, 2],
+                                    layer_res_blocks=[1, 1, 1, 1],
+                                    norm_groups=4,
+                                    first_conv_channels=48,
+                                    time_embedding_dims=32,
+                                    max_time_emb_frequency=200.0)
+    diffusion_model = DiffusionModel(unet)
+    diffusion_model.compile(optimizer=keras.optimizers.AdamW(learning_rate=1e-3, weight_decay=1e-4),
+                            loss=keras.losses.mean_absolute_error,
+                            jit_compile=jit_compile)
+
+    data = np.random.default_rng(0).normal(size=(batch_size * (steps + warmup_steps), *shape, latent_dims))
+    data = data.astype(np.float32)
+    diffusion_model.learn_data_distribution(data)
+
+    diffusion_model.fit(data[:batch_size * warmup_steps], batch_size=batch_size, epochs=1, verbose=0)
+    start = time.perf_counter()
+    history = diffusion_model.fit(data[batch_size * warmup_steps:], batch_size=batch_size, epochs=1, verbose=0)
+    seconds = time.perf_counter() - start
+
+    return {
+        'precision': precision,
+        'jit_compile': jit_compile,
+        'steps_per_second': steps / seconds,
+        'peak_memory_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'loss': float(history.history['noise_loss'][-1]),
+    }
+
+
+def _main():
+    parser = argparse.ArgumentParser(description='DiffusionModel training speed per precision and XLA compilation.')
+    parser.add_argument('--precisions', nargs='+', default=['float32', 'mixed_bfloat16', 'mixed_float16'])
+    parser.add_argument('--jit-compile', nargs='+', type=int, default=[0, 1])
+    parser.add_argument('--shape', nargs='+', type=int, default=[32, 32])
+    parser.add_argument('--latent-dims', type=int, default=4)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--steps', type=int, default=20)
+    parser.add_argument('--warmup-steps', type=int, default=3)
+    parser.add_argument('--configuration', nargs=2, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.configuration is not None:
+        precision, jit_compile = args.configuration
+        result = run_configuration(precision, bool(int(jit_compile)), tuple(args.shape), args.latent_dims,
+                                   args.batch_size, args.steps, args.warmup_steps)
+        print(json.dumps(result))
+        return
+
+    common = ['--shape', *map(str, args.shape), '--latent-dims', str(args.latent_dims),
+              '--batch-size', str(args.batch_size), '--steps', str(args.steps),
+              '--warmup-steps', str(args.warmup_steps)]
+    print(f"{'precision':<16}{'xla':>5}{'steps/s':>10}{'peak MB':>10}{'loss':>9}")
+    for precision in args.precisions:
+        for jit_compile in args.jit_compile:
+            output = subprocess.run([sys.executable, '-m', 'benchmarks.training_speed', *common,
+                                     '--configuration', precision, str(jit_compile)],
+                                    capture_output=True, text=True, check=True).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            print(f"{precision:<16}{jit_compile:>5}{result['steps_per_second']:>10.2f}"
+                  f"{result['peak_memory_mb']:>10.0f}{result['loss']:>9.4f}", flush=True)
+
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,68 @@
+import gzip
+import json
+import numpy as np
+import pytest
+from voxelnn import dataset_manipulation as dm
+from voxelnn.entry_writer import EntryWriter
+
+TAG_NAMES = ['cave', 'tree "oak"']
+BLOCK_NAMES = ['empty', 'grass', 'stone']
+
+
+def _entries(count: int, shape: tuple[int, ...] = (4, 3, 2)) -> list[tuple[str, np.ndarray, np.ndarray]]:
+    rng = np.random.default_rng(0)
+    return [(f'Entry {i}', rng.integers(0, 2, len(TAG_NAMES)),
+             rng.integers(0, len(BLOCK_NAMES), shape, dtype=np.uint8))
+            for i in range(count)]
+
+
+def _expected_json(entries) -> bytes:
+    return json.dumps([dm.construct_entry_dto(name, TAG_NAMES, tags, BLOCK_NAMES, blocks)
+                       for name, tags, blocks in entries]).encode('ascii')
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_shards_match_construct_entry_dto(tmp_path, compress):
+    entries = _entries(10)
+    with EntryWriter(str(tmp_path / 'generated'), TAG_NAMES, BLOCK_NAMES, max_shard_bytes=500,
+                     compress=compress) as writer:
+        for entry in entries:
+            writer.write(*entry)
+
+    assert len(writer.paths) > 1
+    open_shard = gzip.open if compress else open
+    loaded = []
+    for path in writer.paths:
+        with open_shard(path, 'rb') as f:
+            content = f.read()
+        assert len(content) <= 500
+        loaded.extend(json.loads(content))
+    assert json.dumps(loaded).encode('ascii') == _expected_json(entries)
+
+
+def test_single_shard_is_byte_equal(tmp_path):
+    entries = _entries(3)
+    with EntryWriter(str(tmp_path / 'generated'), TAG_NAMES, BLOCK_NAMES) as writer:
+        for entry in entries:
+            writer.write(*entry)
+
+    with open(writer.paths[0], 'rb') as f:
+        assert f.read() == _expected_json(entries)
+
+
+def test_no_entries_give_an_empty_shard(tmp_path):
+    with EntryWriter(str(tmp_path / 'generated'), TAG_NAMES, BLOCK_NAMES) as writer:
+        pass
+
+    with open(writer.paths[0], 'rb') as f:
+        assert f.read() == b'[]'
+
+
+def test_exception_leaves_no_shard(tmp_path):
+    with pytest.raises(RuntimeError):
+        with EntryWriter(str(tmp_path / 'generated'), TAG_NAMES, BLOCK_NAMES) as writer:
+            writer.write(*_entries(1)[0])
+            raise RuntimeError('generation failed')
+
+    assert writer.paths == []
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,54 @@
+import json
+import pytest
+from voxelnn.dataset_manipulation import iter_entries
+
+ENTRIES = [
+    {'FriendlyName': 'Hill "north"', 'Tags': ['hill'], 'Dimensions': [2, 2], 'BlockNames': ['air', 'stone'],
+     'Blocks': [0, 1, 1, 0]},
+    {'FriendlyName': 'Łąka 😀', 'Tags': [], 'Dimensions': [1, 3], 'BlockNames': ['grass'], 'Blocks': [0, 0, 0]},
+]
+
+
+def _write(tmp_path, content: str) -> str:
+    path = tmp_path / 'entries.json'
+    path.write_bytes(content.encode('utf-8'))
+    return str(path)
+
+
+@pytest.mark.parametrize('indent', [None, 2])
+@pytest.mark.parametrize('chunk_size', [1, 2, 7, 64, 1 << 20])
+def test_matches_json_load(tmp_path, indent, chunk_size):
+    path = _write(tmp_path, json.dumps(ENTRIES, indent=indent, ensure_ascii=False) + '\n')
+    assert list(iter_entries(path, chunk_size=chunk_size)) == ENTRIES
+
+
+@pytest.mark.parametrize('content', ['[]', ' [ ]\n'])
+def test_empty_array(tmp_path, content):
+    assert not list(iter_entries(_write(tmp_path, content)))
+
+
+@pytest.mark.parametrize('chunk_size', [1, 64, 1 << 20])
+@pytest.mark.parametrize('content', [
+    '[{"a": 1},]',
+    '[{"a": 1}] junk',
+    '[{"a": 1}]]',
+    '[,{"a": 1}]',
+    '[{"a": 1} {"b": 2}]',
+    '[{"a": 1}',
+    '',
+])
+def test_rejects_what_json_load_rejects(tmp_path, chunk_size, content):
+    path = _write(tmp_path, content)
+    with pytest.raises(json.JSONDecodeError):
+        with open(path, encoding='utf-8') as f:
+            json.load(f)
+    with pytest.raises(ValueError):
+        list(iter_entries(path, chunk_size=chunk_size))
+
+
+def test_invalid_entry_fails_without_reading_the_rest(tmp_path):
+    path = tmp_path / 'entries.json'
+    # invalid UTF-8 far after the invalid entry fails decoding, if the rest of the file is read
+    path.write_bytes(b'[{"a": 1}, {"b": nope}, ' + b'{"c": [' + b'1, ' * 10000 + b'\xff]}]')
+    with pytest.raises(ValueError, match="Invalid entry .* at offset 17"):
+        list(iter_entries(str(path), chunk_size=64))
@@ -0,0 +1,327 @@
+"""Headless jobs, driven by a JSON config file, replacing the notebook workflow:
+* `train-ae` - train a VAE or SAE encoder and decoder on the dataset,
+* `encode` - encode the dataset into the latent cache,
+* `train-diffusion` - train the diffusion model on cached latents, resuming from its last checkpoint,
+* `generate` - generate entries into EntryDTO JSON files, as the Unity tool reads them.\n
+Run from the Python directory: `python -m voxelnn train-ae --config run.json --set autoencoder.epochs=10`.
+The config overrides DEFAULT_CONFIG; models are stored in models_directory/group, like jupyter_tools does.
+The effective config is saved next to the results of every job.\n
+generate splits its batches between shard_count jobs, each writing its own files; as every batch
+has its own seed, for a batch size the generated entries don't depend on the number of shards."""
+
+import argparse
+import copy
+import json
+import os
+import numpy as np
+from voxelnn import model_storage
+
+DEFAULT_CONFIG = {
+    'models_directory': '../models/',
+    'group': None,
+    'dataset': [],
+    'dataset_workers': 1,
+    'seed': 1,
+    # threads within an operation and operations run in parallel, 0 for Tensorflow's default
+    'intra_op_threads': 0,
+    'inter_op_threads': 0,
+    'strategy': 'auto',
+    'precision': 'float32',
+    'jit_compile': False,
+    'autoencoder': {
+        'type': 'vae',
+        'latent_dims': 2,
+        'epochs': 100,
+        'batch_size': 32,
+        'validation_split': 0.1,
+        'kld_loss_weight': 0.05,
+        'str_loss_weight': 0.1,
+        'filter_size': 3,
+    },
+    'encode': {
+        # defaults to models_directory/group/latent_cache
+        'cache_directory': None,
+        'batch_size': 256,
+    },
+    'diffusion': {
+        'unet': {
+            'layer_units': [32, 64, 96, 128],
+            'layer_attn_heads': [0, 1, 2, 2],
+            'layer_res_blocks': [1, 1, 1, 1],
+            'norm_groups': 4,
+            'first_conv_channels': 48,
+            'time_embedding_dims': 32,
+            'max_time_emb_frequency': 200.0,
+        },
+        'learning_rate': 1e-3,
+        'weight_decay': 1e-4,
+        'ema': 0.999,
+        'accumulation_steps': 1,
+        'epochs': 100,
+        'batch_size': 32,
+        'flips': True,
+        'rotations': True,
+        'checkpoint_every_epochs': 1,
+    },
+    'generate': {
+        'count': 16,
+        'batch_size': 16,
+        'steps': 25,
+        'method': 'DDIM',
+        'name': 'Generated ({}/{})',
+        'output_directory': 'generated',
+        'shard_index': 0,
+        'shard_count': 1,
+        # every job writes files of at most max_shard_mb (uncompressed), gzipped with compress
+        'max_shard_mb': 64,
+        'compress': False,
+    },
+}
+COMMANDS = ('train-ae', 'encode', 'train-diffusion', 'generate')
+
+
+def _merge(config: dict, overrides: dict) -> dict:
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(config.get(key), dict):
+            _merge(config[key], value)
+        else:
+            config[key] = value
+    return config
+
+
+def load_config(path: str = None, overrides: list[str] = None) -> dict:
+    """Returns DEFAULT_CONFIG overridden by the config file, then by overrides of 'section.key=value',
+    with JSON values (strings may be left unquoted)."""
+    config = copy.deepcopy(DEFAULT_CONFIG)
+    if path is not None:
+        with open(path, 'r', encoding='utf-8') as f:
+            _merge(config, json.load(f))
+    for override in overrides or []:
+        key_path, _, text = override.partition('=')
+        try:
+            value = json.loads(text)
+        except json.JSONDecodeError:
+            value = text
+        *sections, key = key_path.split('.')
+        target = config
+        for section in sections:
+            target = target.setdefault(section, {})
+        target[key] = value
+    if not config['group']:
+        raise ValueError('The config has to name the group of models to work with.')
+    return config
+
+
+def _save_config(config: dict, directory: str, command: str):
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, f'{command}.config.json'), 'w', encoding='utf-8') as f:
+        json.dump(config, f, indent=2)
+
+
+def _setup(config: dict):
+    """Set threads, the random seed and precision, before Tensorflow initializes."""
+    import keras # pylint: disable=import-outside-toplevel
+    from voxelnn import tensorflow_tools as tft # pylint: disable=import-outside-toplevel
+    tft.set_threads(config['intra_op_threads'], config['inter_op_threads'])
+    keras.utils.set_random_seed(config['seed'])
+    tft.set_precision(config['precision'])
+
+
+def _get_strategy(config: dict):
+    from voxelnn import tensorflow_tools as tft # pylint: disable=import-outside-toplevel
+    return tft.get_strategy(config['strategy'])
+
+
+def batch_seed(seed: int, batch_index: int) -> int:
+    """A seed for a batch of generated entries, independent of other batches, which generate won't take as
+    'no seed' (0)."""
+    return int(np.random.SeedSequence([seed, batch_index]).generate_state(1)[0]) % (2**31 - 1) + 1
+
+
+def _load_blocks(config: dict) -> tuple[list[str], list[str], np.ndarray]:
+    from voxelnn import dataset_manipulation as dm # pylint: disable=import-outside-toplevel
+    if not config['dataset']:
+        raise ValueError('The config has to list the dataset files.')
+    tag_names, block_names, _, _, blocks = dm.load_dataset(config['dataset'], workers=config['dataset_workers'])
+    print(f'Loaded {blocks.shape[0]} entries of shape {blocks.shape[1:]}, {len(block_names)} block types')
+    return tag_names, block_names, blocks
+
+
+def _model_directory(config: dict) -> str:
+    return os.path.join(model_storage.path_to_models, config['group'])
+
+
+def _load_model(config: dict, name: str):
+    # register the custom objects needed to load the models
+    import voxelnn.coding.custom_layers # pylint: disable=import-outside-toplevel,unused-import
+    import voxelnn.diffusion.custom_layers # pylint: disable=import-outside-toplevel,unused-import
+    import voxelnn.diffusion.diffusion_model # pylint: disable=import-outside-toplevel,unused-import
+    return model_storage.load_model(config['group'], name)
+
+
+def _load_encoder(config: dict):
+    return _load_model(config, f"{config['autoencoder']['type']}_encoder.keras")
+
+
+def _load_decoder(config: dict):
+    return _load_model(config, f"{config['autoencoder']['type']}_decoder.keras")
+
+
+def _cached_latents(config: dict, encoder, blocks: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    from voxelnn.latent_cache import LatentCache # pylint: disable=import-outside-toplevel
+    cache_directory = config['encode']['cache_directory'] or os.path.join(_model_directory(config), 'latent_cache')
+    return LatentCache(cache_directory).get_or_encode(encoder, blocks, config['encode']['batch_size'])
+
+
+def train_autoencoder(config: dict):
+    from voxelnn import filter_kernels as fk # pylint: disable=import-outside-toplevel
+    from voxelnn.coding import SAE, VAE # pylint: disable=import-outside-toplevel
+    from voxelnn.coding.autoencoder_builder import create_decoder, create_encoder # pylint: disable=import-outside-toplevel
+
+    settings = config['autoencoder']
+    kind = settings['type']
+    if kind not in ('vae', 'sae'):
+        raise ValueError(f"Unknown autoencoder type '{kind}', expected 'vae' or 'sae'.")
+    _setup(config)
+    strategy = _get_strategy(config)
+    tag_names, block_names, blocks = _load_blocks(config)
+    real_dims = blocks.ndim - 1
+
+    with strategy.scope():
+        encoder = create_encoder(len(block_names), settings['latent_dims'], real_dims)
+        decoder = create_decoder(len(block_names), settings['latent_dims'], real_dims)
+        if kind == 'vae':
+            trainer = VAE.VAETrainer(encoder, decoder, kld_loss_weight=settings['kld_loss_weight'])
+        else:
+            trainer = SAE.SAETrainer(encoder, decoder,
+                                     filter_array=fk.create_kernel(settings['filter_size'], real_dims,
+                                                                   settings['latent_dims']),
+                                     kld_loss_weight=settings['kld_loss_weight'],
+                                     str_loss_weight=settings['str_loss_weight'])
+        trainer.compile(jit_compile=config['jit_compile'])
+
+    split = int((1 - settings['validation_split']) * blocks.shape[0])
+    checkpoint = model_storage.training_checkpoint(config['group'], f'{kind}_checkpoints')
+    trainer.fit(blocks[:split], batch_size=settings['batch_size'], epochs=settings['epochs'],
+                validation_data=(blocks[split:], None) if split < blocks.shape[0] else None,
+                callbacks=[checkpoint], verbose=2)
+
+    model_storage.save_model(config['group'], f'{kind}_encoder.keras', encoder)
+    model_storage.save_model(config['group'], f'{kind}_decoder.keras', decoder)
+    model_storage.save_model_data(config['group'], block_names, tag_names)
+    _save_config(config, _model_directory(config), 'train-ae')
+
+
+def encode(config: dict):
+    _setup(config)
+    _, _, blocks = _load_blocks(config)
+    z_mean, _ = _cached_latents(config, _load_encoder(config), blocks)
+    print(f'Cached latents of shape {z_mean.shape}')
+    _save_config(config, _model_directory(config), 'encode')
+
+
+def train_diffusion(config: dict):
+    import keras # pylint: disable=import-outside-toplevel
+    from voxelnn.diffusion import unet_builder # pylint: disable=import-outside-toplevel
+    from voxelnn.diffusion.diffusion_model import DiffusionModel # pylint: disable=import-outside-toplevel
+    from voxelnn.input_pipeline import build_latent_dataset # pylint: disable=import-outside-toplevel
+    from voxelnn.latent_cache import sampling_stddev # pylint: disable=import-outside-toplevel
+
+    settings = config['diffusion']
+    _setup(config)
+    strategy = _get_strategy(config)
+    _, _, blocks = _load_blocks(config)
+    encoder = _load_encoder(config)
+    z_mean, z_log_var = _cached_latents(config, encoder, blocks)
+    stddev = sampling_stddev(encoder)
+
+    with strategy.scope():
+        unet = unet_builder.build_model(input_shape=z_mean.shape[1:-1], latent_dims=z_mean.shape[-1],
+                                        **settings['unet'])
+        diffusion_model = DiffusionModel(unet, ema=settings['ema'], accumulation_steps=settings['accumulation_steps'])
+        diffusion_model.compile(optimizer=keras.optimizers.AdamW(learning_rate=settings['learning_rate'],
+                                                                 weight_decay=settings['weight_decay']),
+                                loss=keras.losses.mean_absolute_error,
+                                jit_compile=config['jit_compile'])
+
+    # the distribution of sampled latents, as in the notebook
+    rng = np.random.default_rng(config['seed'])
+    diffusion_model.learn_data_distribution(
+        z_mean + np.exp(0.5 * z_log_var) * rng.normal(scale=stddev, size=z_mean.shape).astype(z_mean.dtype))
+    dataset = build_latent_dataset(z_mean, z_log_var, settings['batch_size'], stddev=stddev,
+                                   flips=settings['flips'], rotations=settings['rotations'], seed=config['seed'])
+    checkpoint = model_storage.training_checkpoint(config['group'], 'diffusion_checkpoints',
+                                                   every_epochs=settings['checkpoint_every_epochs'])
+    diffusion_model.fit(dataset, epochs=settings['epochs'], callbacks=[checkpoint], verbose=2)
+
+    model_storage.save_model(config['group'], 'diffusion.keras', diffusion_model)
+    _save_config(config, _model_directory(config), 'train-diffusion')
+
+
+def generate(config: dict):
+    from voxelnn.coding.decoding import decode_to_blocks # pylint: disable=import-outside-toplevel
+    from voxelnn.entry_writer import EntryWriter # pylint: disable=import-outside-toplevel
+
+    settings = config['generate']
+    shard_index, shard_count = settings['shard_index'], settings['shard_count']
+    if not 0 <= shard_index < shard_count:
+        raise ValueError(f'Shard index has to be between 0 and {shard_count - 1}, got {shard_index}.')
+    _setup(config)
+    diffusion_model = _load_model(config, 'diffusion.keras')
+    decoder = _load_decoder(config)
+    block_names, tag_names = model_storage.load_model_data(config['group'])
+
+    count, batch_size = settings['count'], settings['batch_size']
+    batch_count = (count + batch_size - 1) // batch_size
+    path_prefix = os.path.join(settings['output_directory'], f'generated-{shard_index:05d}-of-{shard_count:05d}')
+    with EntryWriter(path_prefix, tag_names, block_names, max_shard_bytes=int(settings['max_shard_mb'] * 2**20),
+                     compress=settings['compress']) as writer:
+        for batch_index in range(shard_index, batch_count, shard_count):
+            start = batch_index * batch_size
+            # full batches only, so sampling is traced once
+            pred_data = diffusion_model.generate(diffusion_steps=settings['steps'], element_count=batch_size,
+                                                 seed=batch_seed(config['seed'], batch_index),
+                                                 method=settings['method'], history='none')[0]
+            blocks = decode_to_blocks(decoder, pred_data[:min(batch_size, count - start)])
+            for i in range(blocks.shape[0]):
+                writer.write(str.format(settings['name'], start + i + 1, count), np.zeros(len(tag_names)), blocks[i])
+            print(f'Generated {start + blocks.shape[0]}/{count} entries')
+
+    if shard_index >= batch_count:
+        # the writer leaves an empty shard here, while a job failing within a shard leaves no file for it,
+        # so a job with nothing to do isn't taken for one that crashed
+        print(f'Shard {shard_index} has no batches, only {batch_count} batches for {shard_count} shards')
+    print(f"Wrote {writer.entry_count} entries to {', '.join(writer.paths)}")
+    _save_config(config, settings['output_directory'], f'generate-{shard_index:05d}')
+
+
+def _main():
+    parser = argparse.ArgumentParser(prog='python -m voxelnn', description='Headless training and generation jobs.')
+    parser.add_argument('command', choices=COMMANDS)
+    parser.add_argument('--config', default=None, help='JSON config file, overriding DEFAULT_CONFIG')
+    parser.add_argument('--set', nargs='+', default=[], metavar='KEY=VALUE',
+                        help="override config values, e.g. 'generate.count=64' or 'intra_op_threads=4'")
+    parser.add_argument('--shard-index', type=int, default=None, help='the shard this generate job writes')
+    parser.add_argument('--shard-count', type=int, default=None, help='the number of generate jobs')
+    args = parser.parse_args()
+
+    overrides = list(args.set)
+    if args.shard_index is not None:
+        overrides.append(f'generate.shard_index={args.shard_index}')
+    if args.shard_count is not None:
+        overrides.append(f'generate.shard_count={args.shard_count}')
+    config = load_config(args.config, overrides)
+    # an explicit directory, instead of looking for Google Drive
+    model_storage.path_to_models = config['models_directory']
+
+    commands = {
+        'train-ae': train_autoencoder,
+        'encode': encode,
+        'train-diffusion': train_diffusion,
+        'generate': generate,
+    }
+    commands[args.command](config)
+
+
+if __name__ == '__main__':
+    _main()
@@ -2,6 +2,7 @@
 
 import keras
 import tensorflow as tf
+from voxelnn.tensorflow_tools import scale_loss_for_replicas
 from . import ae_losses
 
 class VAETrainer(keras.Model):
@@ -18,6 +19,10 @@ class VAETrainer(keras.Model):
         self.rcstr_loss_tracker = keras.metrics.Mean(name="rcstr_loss")
         self.kld_loss_tracker = keras.metrics.Mean(name="kl_loss")
 
+        # the trainer has no call() to build it with, and only wraps models, which are built already;
+        # fit under a distribution strategy builds unbuilt models symbolically before training
+        self.built = True
+
     @property
     def metrics(self):
         return [
@@ -27,8 +32,11 @@ class VAETrainer(keras.Model):
         ]
 
     def __eval_vae__(self, data):
+        data, _, _ = keras.utils.unpack_x_y_sample_weight(data)
         z_mean, z_log_var, z = self.encoder(data)
         r = self.decoder(z)
+        # calculate losses in float32 with mixed precision
+        z_mean, z_log_var, r = (tf.cast(t, tf.float32) for t in (z_mean, z_log_var, r))
 
         reconstruction_loss = ae_losses.mean_sparse_categorical_crossentropy(data, r)
 
@@ -40,7 +48,9 @@ class VAETrainer(keras.Model):
     def train_step(self, data):
         with tf.GradientTape() as tape:
             total_loss, rcstr_loss, kld_loss = self.__eval_vae__(data)
-            grads = tape.gradient(total_loss, self.trainable_weights)
+            # averaged over the global batch when distributed
+            scaled_loss = self.optimizer.scale_loss(scale_loss_for_replicas(total_loss))
+            grads = tape.gradient(scaled_loss, self.trainable_weights)
             self.optimizer.apply_gradients(zip(grads, self.trainable_weights))
             self.total_loss_tracker.update_state(total_loss)
             self.rcstr_loss_tracker.update_state(rcstr_loss)
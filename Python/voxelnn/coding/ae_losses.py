@@ -29,7 +29,8 @@ def mean_structurization_loss(z, conv_filter):
     else:
         raise Exception("Only 2D and 3D conv is supported")
 
-    norms = tf.math.reduce_euclidean_norm(z - averages, axis=-1)
+    # tf.norm instead of tf.math.reduce_euclidean_norm, which XLA can't compile
+    norms = tf.norm(z - averages, axis=-1)
     str_loss = tf.reduce_mean(norms)
     
     return str_loss
@@ -0,0 +1,55 @@
+"""Code for building the encoder and decoder models, trained with VAETrainer or SAETrainer."""
+
+import keras
+from keras import layers
+from voxelnn.coding.custom_layers import OneHot, Sampling
+
+
+def _conv(is3d: bool, filters: int, kernel_size=1, activation='elu', padding='same', kernel_initializer='glorot_normal', **kwargs):
+    def apply(x):
+        if is3d:
+            return layers.Conv3D(filters=filters, kernel_size=kernel_size, activation=activation, padding=padding, kernel_initializer=kernel_initializer, **kwargs)(x)
+        else:
+            return layers.Conv2D(filters=filters, kernel_size=kernel_size, activation=activation, padding=padding, kernel_initializer=kernel_initializer, **kwargs)(x)
+    return apply
+
+def _encoder_input(is3d: bool):
+    if is3d:
+        return layers.Input(shape=(None, None, None), dtype='uint8', name='encoder_input')
+    else:
+        return layers.Input(shape=(None, None), dtype='uint8', name='encoder_input')
+
+def _decoder_input(is3d: bool, latent_dimensions: int):
+    if is3d:
+        return layers.Input(shape=(None, None, None, latent_dimensions), name='decoder_input')
+    else:
+        return layers.Input(shape=(None, None, latent_dimensions), name='decoder_input')
+
+def create_encoder(block_type_count: int, latent_dimensions: int, real_dims: int = 2) -> keras.Model:
+    """An encoder of block IDs of any shape (real_dims 2 or 3) into z_mean, z_log_var and sampled z,
+    working on each voxel separately."""
+    is3d = real_dims == 3
+    input = _encoder_input(is3d)
+    oh = OneHot(block_type_count)(input)
+    c1  = _conv(is3d, filters=40, kernel_size=1, padding='same', activation='elu', kernel_initializer='glorot_normal')(oh)
+    c2  = _conv(is3d, filters=30, kernel_size=1, padding='same', activation='elu', kernel_initializer='glorot_normal')(c1)
+    c3a  = _conv(is3d, filters=20, kernel_size=1, padding='same', activation='elu', kernel_initializer='glorot_normal')(c2)
+    c3b  = _conv(is3d, filters=20, kernel_size=1, padding='same', activation='elu', kernel_initializer='glorot_normal')(c2)
+    mean = _conv(is3d, filters=latent_dimensions, kernel_size=1, padding='same', activation='linear', name='mean')(c3a)
+    var = _conv(is3d, filters=latent_dimensions, kernel_size=1, padding='same', activation='linear', kernel_initializer='zeros', name='var')(c3b)
+    z = Sampling(name='encoder_output')([mean, var])
+    encoder = keras.Model(input, [mean, var, z], name="encoder")
+    return encoder
+
+def create_decoder(block_type_count: int, latent_dimensions: int, real_dims: int = 2) -> keras.Model:
+    """A decoder of latents of any shape (real_dims 2 or 3) into block probabilities, working on each voxel
+    separately."""
+    is3d = real_dims == 3
+    input = _decoder_input(is3d, latent_dimensions)
+    c1 = _conv(is3d, filters=30, kernel_size=1, padding='same', activation='elu')(input)
+    c2 = _conv(is3d, filters=40, kernel_size=1, padding='same', activation='elu')(c1)
+    c3 = _conv(is3d, filters=50, kernel_size=1, padding='same', activation='elu')(c2)
+    c4 = _conv(is3d, block_type_count, kernel_size=1, padding='same', activation='linear', name='decoder_output')(c3)
+    sm = layers.Softmax()(c4)
+    decoder = keras.Model(input, sm, name="decoder")
+    return decoder
@@ -22,7 +22,7 @@ class Sampling(layers.Layer):
     def call(self, inputs):
         z_mean, z_log_var = inputs
         g = tf.random.get_global_generator()
-        epsilon = g.normal(shape=tf.shape(z_mean), mean=0., stddev=self.stddev)
+        epsilon = g.normal(shape=tf.shape(z_mean), mean=0., stddev=self.stddev, dtype=z_mean.dtype)
         value = z_mean + tf.exp(0.5 * z_log_var) * epsilon
         return value
 
@@ -42,4 +42,4 @@ class OneHot(layers.Layer):
         pass
 
     def call(self, inputs):
-        return tf.one_hot(inputs, self.depth, on_value=1.0, off_value=0.0, axis=-1)
+        return tf.one_hot(inputs, self.depth, on_value=1.0, off_value=0.0, axis=-1, dtype=self.compute_dtype)
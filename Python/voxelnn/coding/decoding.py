@@ -0,0 +1,69 @@
+"""Decoding latents straight to block IDs, without copying block probabilities off the device."""
+
+import weakref
+import keras
+import numpy as np
+import tensorflow as tf
+from voxelnn.dataset_storage import block_dtype_for
+
+# compiled decode functions, per decoder and confidence flag
+_DECODE_FUNCTIONS = weakref.WeakKeyDictionary()
+
+
+def logits_model(decoder: keras.Model) -> tuple[keras.Model, bool]:
+    """Returns the decoder without its final Softmax layer, if it has one, and whether it was removed."""
+    last_layer = decoder.layers[-1]
+    if isinstance(last_layer, keras.layers.Softmax):
+        return keras.Model(decoder.inputs, last_layer.input, name=f'{decoder.name}_logits'), True
+    return decoder, False
+
+
+def _get_decode_function(decoder: keras.Model, return_confidence: bool):
+    functions = _DECODE_FUNCTIONS.setdefault(decoder, {})
+    if return_confidence not in functions:
+        model, has_logits = logits_model(decoder)
+        # the decoder is the key of the cache, so the function only references it weakly
+        get_model = weakref.ref(model) if model is decoder else lambda: model
+        dtype = tf.as_dtype(block_dtype_for(decoder.output.shape[-1]))
+
+        @tf.function(reduce_retracing=True)
+        def decode(latents):
+            outputs = get_model()(latents, training=False)
+            blocks = tf.cast(tf.argmax(outputs, axis=-1), dtype)
+            if not return_confidence:
+                return blocks
+            if has_logits:
+                # the largest softmax probability, without calculating the others
+                confidence = tf.exp(tf.reduce_max(outputs, axis=-1) - tf.reduce_logsumexp(outputs, axis=-1))
+            else:
+                confidence = tf.reduce_max(outputs, axis=-1)
+            return blocks, confidence
+
+        functions[return_confidence] = decode
+    return functions[return_confidence]
+
+
+def decode_to_blocks(decoder: keras.Model, latents: np.ndarray, batch_size: int = 32,
+                     return_confidence: bool = False) -> np.ndarray | tuple[np.ndarray, np.ndarray]:
+    """Decode latents to block IDs (uint8, or uint16 for more than 256 block types), taking the argmax
+    on the device, so block probabilities are never copied to the host.\n
+    Latents are decoded in chunks of batch_size entries. A final Softmax layer of the decoder is skipped.
+    With return_confidence, the probability of the chosen block per voxel is returned as well."""
+    if latents.shape[0] == 0:
+        blocks = np.empty(latents.shape[:-1], dtype=block_dtype_for(decoder.output.shape[-1]))
+        return (blocks, np.empty(blocks.shape, dtype=np.float32)) if return_confidence else blocks
+
+    decode = _get_decode_function(decoder, return_confidence)
+    blocks, confidences = [], []
+    for start in range(0, latents.shape[0], batch_size):
+        result = decode(tf.convert_to_tensor(latents[start:start + batch_size], dtype=tf.float32))
+        if return_confidence:
+            blocks.append(result[0].numpy())
+            confidences.append(result[1].numpy())
+        else:
+            blocks.append(result.numpy())
+
+    blocks = np.concatenate(blocks)
+    if return_confidence:
+        return blocks, np.concatenate(confidences)
+    return blocks
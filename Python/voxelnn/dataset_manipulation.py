@@ -1,37 +1,298 @@
 """Methods to manipulate the dataset."""
 
 import json
+import re
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
+from voxelnn import dataset_storage
 
-def load_dataset(file_paths: list) -> tuple[list[str], list[str], list[str], np.ndarray, np.ndarray]:
-    """Load entries from a list of files, then preprocess the entries into a unified dataset."""
-    loaded_list = []
-    for file_path in file_paths:
-        with open(file_path, encoding='utf-8') as content:
-            obj = json.load(content)
-            loaded_list.extend(obj)
+def load_dataset(file_paths: list, workers: int = 1, bucket_by_shape: bool = False
+                 ) -> tuple[list[str], list[str],
+                            list[str] | dict[tuple[int, ...], list[str]],
+                            np.ndarray | dict[tuple[int, ...], np.ndarray],
+                            np.ndarray | dict[tuple[int, ...], np.ndarray]]:
+    """Load entries from a list of files, then preprocess the entries into a unified dataset.\n
+    Files may be JSON files or binary dataset files (see dataset_storage). A single binary file
+    is opened as a memory map, so the returned block tensor is a read-only view of the file.\n
+    With workers other than 1, JSON files are parsed in a process pool of that size (None uses all cores).
+    The result doesn't depend on the number of workers.\n
+    Returns tag names, block names, entry names, the multilabel tag matrix and the block tensor.
+    Entries of different dimensions are only allowed with bucket_by_shape. Entry names, tags and blocks
+    are then always returned as dictionaries keyed by entry dimensions (even for a single shape), sharing
+    the tag and block vocabularies. Use input_pipeline.build_dataset to train on them."""
+    is_binary = [dataset_storage.is_binary_dataset(p) for p in file_paths]
+    json_paths = [p for p, binary in zip(file_paths, is_binary) if not binary]
+
+    if workers != 1 and len(json_paths) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            json_parts = list(executor.map(_load_json_file, json_paths))
+    else:
+        json_parts = [_load_json_file(p) for p in json_paths]
+
+    json_parts = iter(json_parts)
+    parts = [part
+             for p, binary in zip(file_paths, is_binary)
+             for part in ([dataset_storage.open_dataset(p)] if binary else next(json_parts))]
+
+    if not bucket_by_shape:
+        return _merge_parts(parts)
+
+    tag_names = sorted(list({tag for part in parts for tag in part[0]}))
+    block_names = sorted(list({block for part in parts for block in part[1]}))
+    buckets = {}
+    for part in parts:
+        buckets.setdefault(part[4].shape[1:], []).append(part)
+
+    entry_names, tags_multilabel, blocks = {}, {}, {}
+    for dimensions in sorted(buckets.keys()):
+        _, _, entry_names[dimensions], tags_multilabel[dimensions], blocks[dimensions] = \
+            _merge_parts(buckets[dimensions], tag_names, block_names)
 
-    entry_names = [obj['FriendlyName'] for obj in loaded_list]
+    return (tag_names, block_names, entry_names, tags_multilabel, blocks)
+
+
+def _load_json_file(file_path: str) -> list[tuple[list[str], list[str], list[str], np.ndarray, np.ndarray]]:
+    """Load a single JSON file, with tag and block vocabularies local to the file.\n
+    Returns a dataset for each distinct entry dimensions in the file, in order of appearance."""
+    with open(file_path, encoding='utf-8') as content:
+        loaded_list = json.load(content)
 
     tag_names = sorted(list({tag for obj in loaded_list for tag in obj['Tags']}))
 
     block_names = sorted(list({block for obj in loaded_list for block in obj['BlockNames']}))
 
-    dimensions_set = {tuple(obj['Dimensions']) for obj in loaded_list}
+    groups = {}
+    for obj in loaded_list:
+        groups.setdefault(tuple(obj['Dimensions']), []).append(obj)
+
+    parts = []
+    for dimensions, entries in groups.items():
+        entry_names = [obj['FriendlyName'] for obj in entries]
+        tags_multilabel = _encode_tags(entries, tag_names)
+        blocks = _encode_blocks(entries, block_names, dimensions)
+        parts.append((tag_names, block_names, entry_names, tags_multilabel, blocks))
+
+    return parts
+
+
+def _single_dimensions(dimensions_set: set[tuple[int, ...]]) -> tuple[int, ...]:
     dimensions = (0,)
     try:
         (dimensions,) = dimensions_set
     except Exception as e:
         print(f'Variable dimensions detected: {dimensions_set}')
         raise e
+    return dimensions
 
-    tags_multilabel = np.array([[1 if tag_name in obj['Tags'] else 0 for tag_name in tag_names] for obj in loaded_list]).reshape((-1, len(tag_names)))
 
-    for obj in loaded_list:
-        local_to_global_map = [block_names.index(b) for b in obj['BlockNames']]
-        obj['Blocks'] = [local_to_global_map[b] for b in obj['Blocks']]
+def _merge_parts(parts: list[tuple], tag_names: list[str] = None, block_names: list[str] = None
+                 ) -> tuple[list[str], list[str], list[str], np.ndarray, np.ndarray]:
+    """Merge datasets into one, with sorted global tag and block vocabularies,
+    unless the vocabularies are given. Entries keep the order of the parts."""
+    tag_names = tag_names or sorted(list({tag for part in parts for tag in part[0]}))
+    block_names = block_names or sorted(list({block for part in parts for block in part[1]}))
+    dimensions = _single_dimensions({part[4].shape[1:] for part in parts})
+
+    if len(parts) == 1 and parts[0][0] == tag_names and parts[0][1] == block_names:
+        return parts[0]
+
+    entry_names = [name for part in parts for name in part[2]]
+    tags_dtype = np.result_type(*(part[3].dtype for part in parts))
+    blocks_dtype = np.promote_types(np.result_type(*(part[4].dtype for part in parts)),
+                                    dataset_storage.block_dtype_for(len(block_names)))
+    tags_multilabel = np.zeros((len(entry_names), len(tag_names)), dtype=tags_dtype)
+    blocks = np.empty((len(entry_names), *dimensions), dtype=blocks_dtype)
+
+    tag_indices = {name: i for i, name in enumerate(tag_names)}
+    block_indices = {name: i for i, name in enumerate(block_names)}
+    offset = 0
+    for part_tag_names, part_block_names, part_entry_names, part_tags, part_blocks in parts:
+        count = len(part_entry_names)
+        columns = [tag_indices[tag] for tag in part_tag_names]
+        tags_multilabel[offset:offset + count, columns] = part_tags
+        local_to_global_map = np.array([block_indices[b] for b in part_block_names], dtype=blocks_dtype)
+        blocks[offset:offset + count] = local_to_global_map[part_blocks]
+        offset += count
+
+    return (tag_names, block_names, entry_names, tags_multilabel, blocks)
+
+
+def count_bucketed_batches(blocks: dict[tuple[int, ...], np.ndarray], batch_size: int,
+                           drop_remainder: bool = False) -> int:
+    """Count batches yielded by a single pass of iterate_bucketed_batches."""
+    if drop_remainder:
+        return sum(len(array) // batch_size for array in blocks.values())
+    return sum(-(-len(array) // batch_size) for array in blocks.values())
+
+
+def iterate_bucketed_batches(blocks: dict[tuple[int, ...], np.ndarray], batch_size: int,
+                             shuffle: bool = True, seed: int = None,
+                             drop_remainder: bool = False, repeat: bool = False):
+    """Yield batches of blocks from a bucketed dataset, as 1-tuples like keras expects from generators.
+    Every batch contains entries of the same shape.\n
+    Batches of all buckets are interleaved in random order when shuffling. With repeat, passes over
+    the dataset are repeated forever.
+
+    Keras fixes the shape of generator batches from the first ones, so don't pass this to fit;
+    input_pipeline.build_dataset builds a dataset of bucketed batches, which fit accepts."""
+    rng = np.random.default_rng(seed)
+    while True:
+        batches = []
+        for dimensions, array in blocks.items():
+            indices = rng.permutation(len(array)) if shuffle else np.arange(len(array))
+            for start in range(0, len(array), batch_size):
+                batch_indices = indices[start:start + batch_size]
+                if drop_remainder and len(batch_indices) < batch_size:
+                    continue
+                batches.append((dimensions, np.sort(batch_indices)))
+
+        order = rng.permutation(len(batches)) if shuffle else range(len(batches))
+        for i in order:
+            dimensions, batch_indices = batches[i]
+            yield (blocks[dimensions][batch_indices],)
+
+        if not repeat:
+            return
+
+
+def _encode_tags(entries: list[dict], tag_names: list[str]) -> np.ndarray:
+    """Build a multilabel matrix of 1/0 markers by scattering ones at (entry, tag) indices."""
+    tag_indices = {name: i for i, name in enumerate(tag_names)}
+    rows = np.repeat(np.arange(len(entries)), [len(obj['Tags']) for obj in entries])
+    columns = np.fromiter((tag_indices[tag] for obj in entries for tag in obj['Tags']),
+                          dtype=np.int64, count=len(rows))
+    tags_multilabel = np.zeros((len(entries), len(tag_names)), dtype=int)
+    tags_multilabel[rows, columns] = 1
+    return tags_multilabel
+
+
+def _encode_blocks(entries: list[dict], block_names: list[str], dimensions: tuple[int, ...]) -> np.ndarray:
+    """Remap entry blocks from their local palettes to indices into block_names.\n
+    Entries sharing a local palette are remapped together, with a single lookup table."""
+    block_indices = {name: i for i, name in enumerate(block_names)}
+    palettes = {}
+    for i, obj in enumerate(entries):
+        palettes.setdefault(tuple(obj['BlockNames']), []).append(i)
+
+    blocks = np.empty((len(entries), *dimensions), dtype=int)
+    for palette, indices in palettes.items():
+        local_to_global_map = np.array([block_indices[b] for b in palette], dtype=int)
+        local_blocks = np.array([entries[i]['Blocks'] for i in indices])
+        blocks[indices] = local_to_global_map[local_blocks].reshape((-1, *dimensions))
+    return blocks
+
+
+_WHITESPACE = re.compile(r'\s*')
+# an incomplete entry fails to decode within this many characters of the end of the buffer
+# (after a cut literal, number or escape), or at the start of a cut string
+_INCOMPLETE_TAIL = 8
+
+def iter_entries(file_path: str, chunk_size: int = 1 << 20):
+    """Yield entries of a JSON dataset file (an array of entry objects) one at a time.\n
+    The file is read in chunks, so only the entry being decoded is held in memory. Files json.load
+    rejects are rejected as well, as soon as the error is read."""
+    decoder = json.JSONDecoder()
+    with open(file_path, encoding='utf-8') as f:
+        buffer = ''
+        # characters of the file before the buffer
+        offset = 0
+        position = 0
+        expected = '['
+        while True:
+            position = _WHITESPACE.match(buffer, position).end()
+            if position == len(buffer):
+                offset += len(buffer)
+                buffer = f.read(chunk_size)
+                position = 0
+                if not buffer:
+                    if expected == 'end':
+                        return
+                    raise ValueError(f"Unexpected end of file in '{file_path}'.")
+                continue
+
+            char = buffer[position]
+            if expected == 'end':
+                raise ValueError(f"Unexpected data after the entries in '{file_path}' at offset {offset + position}.")
+            if expected == '[':
+                if char != '[':
+                    raise ValueError(f"'{file_path}' doesn't contain an array of entries.")
+                position += 1
+                expected = 'first entry'
+            elif char == ']':
+                if expected == 'entry':
+                    raise ValueError(f"Expected an entry after ',' in '{file_path}'.")
+                position += 1
+                expected = 'end'
+            elif expected == ',':
+                if char != ',':
+                    raise ValueError(f"Expected ',' between entries in '{file_path}'.")
+                position += 1
+                expected = 'entry'
+            else:
+                try:
+                    entry, position = decoder.raw_decode(buffer, position)
+                except json.JSONDecodeError as e:
+                    if e.pos < len(buffer) - _INCOMPLETE_TAIL and not e.msg.startswith('Unterminated string'):
+                        raise ValueError(f"Invalid entry in '{file_path}' at offset {offset + e.pos}: {e.msg}.") from e
+                    # the entry is incomplete, read at least as much as is buffered to stay linear in entry size
+                    chunk = f.read(max(chunk_size, len(buffer) - position))
+                    if not chunk:
+                        raise ValueError(f"Unexpected end of file in '{file_path}'.") from e
+                    offset += position
+                    buffer = buffer[position:] + chunk
+                    position = 0
+                    continue
+                yield entry
+                expected = ','
+
+
+def scan_entries(file_paths: list) -> tuple[list[str], list[str], list[str], tuple[int, ...]]:
+    """First pass of streaming loading: collect tag names, block names, entry names and dimensions."""
+    tag_set = set()
+    block_set = set()
+    entry_names = []
+    dimensions_set = set()
+    for file_path in file_paths:
+        for obj in iter_entries(file_path):
+            entry_names.append(obj['FriendlyName'])
+            tag_set.update(obj['Tags'])
+            block_set.update(obj['BlockNames'])
+            dimensions_set.add(tuple(obj['Dimensions']))
+
+    return (sorted(list(tag_set)), sorted(list(block_set)), entry_names, _single_dimensions(dimensions_set))
+
+
+def fill_entries(file_paths: list, tag_names: list[str], block_names: list[str],
+                 tags_multilabel: np.ndarray, blocks: np.ndarray):
+    """Second pass of streaming loading: write tags and globally indexed blocks of every entry
+    into preallocated arrays (which may be memory maps)."""
+    tag_indices = {name: i for i, name in enumerate(tag_names)}
+    block_indices = {name: i for i, name in enumerate(block_names)}
+    dimensions = blocks.shape[1:]
+    maps = {}
+    i = 0
+    for file_path in file_paths:
+        for obj in iter_entries(file_path):
+            palette = tuple(obj['BlockNames'])
+            if palette not in maps:
+                maps[palette] = np.array([block_indices[b] for b in palette], dtype=blocks.dtype)
+            blocks[i] = maps[palette][np.asarray(obj['Blocks'])].reshape(dimensions)
+            tags_multilabel[i, [tag_indices[tag] for tag in obj['Tags']]] = 1
+            i += 1
+
+    if i != blocks.shape[0]:
+        raise ValueError(f'Expected {blocks.shape[0]} entries, but found {i}.')
+
+
+def load_dataset_streaming(file_paths: list) -> tuple[list[str], list[str], list[str], np.ndarray, np.ndarray]:
+    """Load JSON files like load_dataset, in two passes over the files, decoding one entry at a time.\n
+    Peak memory is close to the size of the result: blocks are stored with the smallest
+    sufficient unsigned dtype (see dataset_storage.block_dtype_for) and tags as uint8."""
+    tag_names, block_names, entry_names, dimensions = scan_entries(file_paths)
 
-    blocks = np.array([obj['Blocks'] for obj in loaded_list]).reshape((-1, *dimensions))
+    tags_multilabel = np.zeros((len(entry_names), len(tag_names)), dtype=np.uint8)
+    blocks = np.empty((len(entry_names), *dimensions), dtype=dataset_storage.block_dtype_for(len(block_names)))
+    fill_entries(file_paths, tag_names, block_names, tags_multilabel, blocks)
 
     return (tag_names, block_names, entry_names, tags_multilabel, blocks)
 
@@ -0,0 +1,186 @@
+"""Compact binary storage for datasets, readable without parsing JSON.\n
+A file consists of:
+* an 8 byte magic marker, followed by the header length as a little-endian uint64,
+* a UTF-8 JSON header holding the vocabularies, entry names, dimensions and the block dtype,
+* the block tensor (uint8 or uint16, C order), starting at a 64 byte aligned offset,
+* the tag bitmap (one bit-packed row per entry), starting at a 64 byte aligned offset.
+
+Use `python -m voxelnn.dataset_storage ../Dataset/*.json` to convert existing JSON files."""
+
+import argparse
+import json
+import os
+import numpy as np
+
+MAGIC = b'VXNNDS\x00\x01'
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+FILE_EXTENSION = '.vxd'
+_PREAMBLE_SIZE = len(MAGIC) + 8
+_WRITE_CHUNK_ENTRIES = 1024
+
+
+def block_dtype_for(block_count: int) -> np.dtype:
+    """Returns the smallest unsigned integer dtype able to index block_count block types."""
+    if block_count <= 2**8:
+        return np.dtype(np.uint8)
+    if block_count <= 2**16:
+        return np.dtype(np.uint16)
+    raise ValueError(f'Too many block types to store: {block_count}.')
+
+
+def _align(offset: int) -> int:
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _layout(header: dict, header_length: int) -> tuple[int, int, int]:
+    """Calculate offsets of the block tensor and the tag bitmap, and the bitmap row size."""
+    entry_count = header['entry_count']
+    voxel_count = int(np.prod(header['dimensions'], dtype=np.int64))
+    itemsize = np.dtype(header['block_dtype']).itemsize
+    blocks_offset = _align(_PREAMBLE_SIZE + header_length)
+    tags_offset = _align(blocks_offset + entry_count * voxel_count * itemsize)
+    tags_row_bytes = (len(header['tag_names']) + 7) // 8
+    return blocks_offset, tags_offset, tags_row_bytes
+
+
+def is_binary_dataset(file_path: str) -> bool:
+    """Check if the file starts with the binary dataset marker."""
+    with open(file_path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def _dataset_header(tag_names: list[str], block_names: list[str], entry_names: list[str],
+                    dimensions: tuple[int, ...]) -> dict:
+    return {
+        'version': FORMAT_VERSION,
+        'entry_count': len(entry_names),
+        'dimensions': list(dimensions),
+        'block_dtype': block_dtype_for(len(block_names)).name,
+        'tag_names': list(tag_names),
+        'block_names': list(block_names),
+        'entry_names': list(entry_names),
+    }
+
+
+def _write_header(f, header: dict) -> tuple[int, int, int]:
+    """Write the preamble and the header, then pad the file up to the block tensor.\n
+    Returns the layout of the file."""
+    header_bytes = json.dumps(header).encode('utf-8')
+    layout = _layout(header, len(header_bytes))
+    f.write(MAGIC)
+    f.write(len(header_bytes).to_bytes(8, 'little'))
+    f.write(header_bytes)
+    f.write(b'\x00' * (layout[0] - f.tell()))
+    return layout
+
+
+def _write_tags(f, tags_offset: int, tags_multilabel: np.ndarray):
+    f.seek(tags_offset)
+    np.packbits(np.asarray(tags_multilabel).astype(bool), axis=1).tofile(f)
+
+
+def write_dataset(file_path: str,
+                  tag_names: list[str],
+                  block_names: list[str],
+                  entry_names: list[str],
+                  tags_multilabel: np.ndarray,
+                  blocks: np.ndarray):
+    """Write a dataset, as returned by load_dataset, to a binary file."""
+    entry_count = blocks.shape[0]
+    if len(entry_names) != entry_count or tags_multilabel.shape[0] != entry_count:
+        raise ValueError('Entry names, tags and blocks have to describe the same number of entries.')
+
+    header = _dataset_header(tag_names, block_names, entry_names, blocks.shape[1:])
+    with open(file_path, 'wb') as f:
+        _, tags_offset, _ = _write_header(f, header)
+        # convert in chunks, so that a large int64 block tensor doesn't get copied all at once
+        for start in range(0, entry_count, _WRITE_CHUNK_ENTRIES):
+            chunk = blocks[start:start + _WRITE_CHUNK_ENTRIES]
+            np.ascontiguousarray(chunk, dtype=header['block_dtype']).tofile(f)
+        f.write(b'\x00' * (tags_offset - f.tell()))
+        _write_tags(f, tags_offset, tags_multilabel)
+
+
+def read_header(file_path: str) -> dict:
+    """Read only the header of a binary dataset file."""
+    with open(file_path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"'{file_path}' is not a binary dataset file.")
+        header_length = int.from_bytes(f.read(8), 'little')
+        header = json.loads(f.read(header_length).decode('utf-8'))
+    if header['version'] != FORMAT_VERSION:
+        raise ValueError(f"Unsupported binary dataset version: {header['version']}.")
+    header['_header_length'] = header_length
+    return header
+
+
+def open_dataset(file_path: str) -> tuple[list[str], list[str], list[str], np.ndarray, np.ndarray]:
+    """Open a binary dataset file. Returns the same tuple as load_dataset.\n
+    The block tensor is a read-only memory map of the file, so nothing is read until it is accessed.
+    Tags are unpacked into an uint8 matrix of 1/0 markers."""
+    header = read_header(file_path)
+    blocks_offset, tags_offset, tags_row_bytes = _layout(header, header['_header_length'])
+    entry_count = header['entry_count']
+    dimensions = tuple(header['dimensions'])
+    tag_count = len(header['tag_names'])
+
+    if entry_count == 0:
+        blocks = np.zeros((0, *dimensions), dtype=header['block_dtype'])
+    else:
+        blocks = np.memmap(file_path, dtype=header['block_dtype'], mode='r',
+                           offset=blocks_offset, shape=(entry_count, *dimensions))
+
+    if entry_count == 0 or tag_count == 0:
+        tags_multilabel = np.zeros((entry_count, tag_count), dtype=np.uint8)
+    else:
+        packed_tags = np.memmap(file_path, dtype=np.uint8, mode='r',
+                                offset=tags_offset, shape=(entry_count, tags_row_bytes))
+        tags_multilabel = np.unpackbits(packed_tags, axis=1, count=tag_count)
+
+    return (header['tag_names'], header['block_names'], header['entry_names'], tags_multilabel, blocks)
+
+
+def convert_json_files(file_paths: list, output_path: str):
+    """Store JSON dataset files as a single binary dataset file.\n
+    Entries are streamed from the JSON files straight into the output file,
+    so the dataset doesn't have to fit in memory."""
+    from voxelnn import dataset_manipulation as dm # pylint: disable=import-outside-toplevel
+    tag_names, block_names, entry_names, dimensions = dm.scan_entries(file_paths)
+    header = _dataset_header(tag_names, block_names, entry_names, dimensions)
+    with open(output_path, 'wb') as f:
+        blocks_offset, tags_offset, _ = _write_header(f, header)
+        f.truncate(tags_offset)
+
+    tags_multilabel = np.zeros((len(entry_names), len(tag_names)), dtype=np.uint8)
+    if entry_names:
+        blocks = np.memmap(output_path, dtype=header['block_dtype'], mode='r+',
+                           offset=blocks_offset, shape=(len(entry_names), *dimensions))
+        dm.fill_entries(file_paths, tag_names, block_names, tags_multilabel, blocks)
+        blocks.flush()
+        del blocks
+
+    with open(output_path, 'r+b') as f:
+        _write_tags(f, tags_offset, tags_multilabel)
+
+
+def _main():
+    parser = argparse.ArgumentParser(description='Convert JSON dataset files into the binary dataset format.')
+    parser.add_argument('files', nargs='+', help='JSON dataset files to convert')
+    parser.add_argument('-o', '--output', default=None,
+                        help=f'merge all files into this file, instead of writing a {FILE_EXTENSION} file next to each input')
+    args = parser.parse_args()
+
+    if args.output is not None:
+        convert_json_files(args.files, args.output)
+        print(f'{args.files} -> {args.output}')
+        return
+
+    for file_path in args.files:
+        output_path = os.path.splitext(file_path)[0] + FILE_EXTENSION
+        convert_json_files([file_path], output_path)
+        print(f'{file_path} -> {output_path}')
+
+
+if __name__ == '__main__':
+    _main()
@@ -38,3 +38,145 @@ class TimeEmbedding(layers.Layer):
 
     def build(self, input_shape = None):
         pass
+
+@keras.saving.register_keras_serializable('voxel-nn')
+class WindowAttention(layers.Layer):
+    """Multi-head self-attention within non-overlapping windows of window_size positions along every spatial axis,
+    so attention scores are only computed between positions of the same window.
+    Spatial dimensions have to be divisible by the window size (or smaller, then the window spans them)."""
+    def __init__(self, num_heads: int, key_dim: int, window_size: int, **kwargs):
+        super().__init__(**kwargs)
+        self.num_heads = num_heads
+        self.key_dim = key_dim
+        self.window_size = window_size
+        self.attention = layers.MultiHeadAttention(num_heads=num_heads, key_dim=key_dim)
+
+    def get_config(self):
+        config = super().get_config()
+        config['num_heads'] = self.num_heads
+        config['key_dim'] = self.key_dim
+        config['window_size'] = self.window_size
+        return config
+
+    def _window_shape(self, spatial_shape) -> list[int]:
+        window_shape = [min(self.window_size, size) for size in spatial_shape]
+        for size, window in zip(spatial_shape, window_shape):
+            if size % window != 0:
+                raise ValueError(f'Spatial shape {tuple(spatial_shape)} is not divisible by window size {window}.')
+        return window_shape
+
+    def build(self, input_shape = None):
+        window_tokens = math.prod(self._window_shape(input_shape[1:-1]))
+        self.attention.build((None, window_tokens, input_shape[-1]), (None, window_tokens, input_shape[-1]))
+
+    def call(self, inputs):
+        spatial_shape = inputs.shape[1:-1]
+        channels = inputs.shape[-1]
+        window_shape = self._window_shape(spatial_shape)
+        window_counts = [size // window for size, window in zip(spatial_shape, window_shape)]
+        rank = len(spatial_shape)
+
+        # [B, n1, w1, n2, w2, ..., C] -> [B, n1, n2, ..., w1, w2, ..., C] -> [B * windows, window tokens, C]
+        split_shape = [-1] + [d for pair in zip(window_counts, window_shape) for d in pair] + [channels]
+        permutation = [0] + [1 + 2 * i for i in range(rank)] + [2 + 2 * i for i in range(rank)] + [2 * rank + 1]
+        x = tf.transpose(tf.reshape(inputs, split_shape), permutation)
+        x = tf.reshape(x, [-1, math.prod(window_shape), channels])
+
+        x = self.attention(x, x)
+
+        x = tf.reshape(x, [-1, *window_counts, *window_shape, channels])
+        x = tf.transpose(x, [permutation.index(i) for i in range(len(permutation))])
+        return tf.reshape(x, [-1, *spatial_shape, channels])
+
+
+@keras.saving.register_keras_serializable('voxel-nn')
+class AxialAttention(layers.Layer):
+    """Multi-head self-attention along each spatial axis in turn, so scores are only computed between positions
+    on the same line, while information still spreads between all positions."""
+    def __init__(self, num_heads: int, key_dim: int, **kwargs):
+        super().__init__(**kwargs)
+        self.num_heads = num_heads
+        self.key_dim = key_dim
+
+    def get_config(self):
+        config = super().get_config()
+        config['num_heads'] = self.num_heads
+        config['key_dim'] = self.key_dim
+        return config
+
+    def build(self, input_shape = None):
+        spatial_shape = input_shape[1:-1]
+        self.attentions = []
+        for axis, size in enumerate(spatial_shape):
+            attention = layers.MultiHeadAttention(num_heads=self.num_heads, key_dim=self.key_dim,
+                                                  name=f'axis_{axis + 1}_attention')
+            attention.build((None, size, input_shape[-1]), (None, size, input_shape[-1]))
+            self.attentions.append(attention)
+
+    def call(self, inputs):
+        spatial_shape = inputs.shape[1:-1]
+        channels = inputs.shape[-1]
+        rank = len(spatial_shape)
+        x = inputs
+        for axis, attention in enumerate(self.attentions):
+            # move the attended axis before the channels, the other axes into the batch
+            permutation = [0] + [1 + i for i in range(rank) if i != axis] + [1 + axis, rank + 1]
+            lines = tf.transpose(x, permutation)
+            lines_shape = tf.shape(lines)
+            lines = tf.reshape(lines, [-1, spatial_shape[axis], channels])
+            lines = tf.reshape(attention(lines, lines), lines_shape)
+            x = tf.transpose(lines, [permutation.index(i) for i in range(rank + 2)])
+        return x
+
+@keras.saving.register_keras_serializable('voxel-nn')
+class ChunkedAttention(layers.Layer):
+    """Multi-head self-attention over all spatial positions, computed for chunk_size queries at a time,
+    so the score matrix of all pairs of positions is never materialized. Scores of a chunk are recomputed
+    for the gradients instead of being kept."""
+    def __init__(self, num_heads: int, key_dim: int, chunk_size: int = 1024, **kwargs):
+        super().__init__(**kwargs)
+        self.num_heads = num_heads
+        self.key_dim = key_dim
+        self.chunk_size = chunk_size
+
+    def get_config(self):
+        config = super().get_config()
+        config['num_heads'] = self.num_heads
+        config['key_dim'] = self.key_dim
+        config['chunk_size'] = self.chunk_size
+        return config
+
+    def build(self, input_shape = None):
+        channels = input_shape[-1]
+        token_shape = (None, None, channels)
+        head_shape = (None, self.num_heads, self.key_dim)
+        self.query_dense = layers.EinsumDense('abc,cde->abde', output_shape=head_shape, bias_axes='de', name='query')
+        self.key_dense = layers.EinsumDense('abc,cde->abde', output_shape=head_shape, bias_axes='de', name='key')
+        self.value_dense = layers.EinsumDense('abc,cde->abde', output_shape=head_shape, bias_axes='de', name='value')
+        self.output_dense = layers.EinsumDense('abde,dec->abc', output_shape=(None, channels), bias_axes='c',
+                                               name='attention_output')
+        for dense in (self.query_dense, self.key_dense, self.value_dense):
+            dense.build(token_shape)
+        self.output_dense.build((None, None, self.num_heads, self.key_dim))
+
+    def call(self, inputs):
+        spatial_shape = inputs.shape[1:-1]
+        channels = inputs.shape[-1]
+        tokens = math.prod(spatial_shape)
+        x = tf.reshape(inputs, [-1, tokens, channels])
+
+        query = self.query_dense(x) * (1.0 / math.sqrt(self.key_dim))
+        key = self.key_dense(x)
+        value = self.value_dense(x)
+
+        @tf.recompute_grad
+        def attend(query_chunk, key, value):
+            scores = tf.einsum('bqhd,bkhd->bhqk', query_chunk, key)
+            # softmax in float32 with mixed precision
+            weights = tf.cast(tf.nn.softmax(tf.cast(scores, tf.float32), axis=-1), value.dtype)
+            return tf.einsum('bhqk,bkhd->bqhd', weights, value)
+
+        outputs = [attend(query[:, start:start + self.chunk_size], key, value)
+                   for start in range(0, tokens, self.chunk_size)]
+        x = self.output_dense(tf.concat(outputs, axis=1))
+        return tf.reshape(x, [-1, *spatial_shape, channels])
@@ -1,32 +1,53 @@
 """This module contains a trainer class for diffusion."""
 
+import contextlib
+import itertools
 import random
-from typing import Tuple
+from typing import Callable, Tuple
 import keras
 from keras import layers
 import tensorflow as tf
 import numpy as np
+from voxelnn.tensorflow_tools import scale_loss_for_replicas
 
 @keras.saving.register_keras_serializable()
 class DiffusionModel(keras.Model):
     def __init__(self, network: keras.Model, min_signal_rate: float = 0.02, max_signal_rate: float = 0.95, ema: float = 0.999,
                  normalizer: keras.layers.Normalization = None, ema_network: keras.Model = None,
+                 ema_every: int = 1, ema_device: str = None, accumulation_steps: int = 1,
                  name: str = "diffusion_model", **kwargs):
+        """The EMA network is updated every ema_every training steps, with the decay corrected to ema ** ema_every.
+        With ema_device (for example '/CPU:0'), the EMA weights are kept and updated on that device.\n
+        With accumulation_steps, every training batch is split into that many micro-batches, evaluated one
+        after another, and their gradients are summed before applying them once. The batch size passed to fit
+        is the effective batch size, while only a micro-batch has to fit into memory at once."""
         super().__init__(name=name, **kwargs)
-        self.normalizer = normalizer or layers.Normalization(axis=-1)
+        # statistics of the data stay in float32 with mixed precision
+        self.normalizer = normalizer or layers.Normalization(axis=-1, dtype='float32')
         self.network = network
-        self.ema_network = ema_network or keras.models.clone_model(network)
+        self.ema_every = ema_every
+        self.ema_device = ema_device
+        self.accumulation_steps = accumulation_steps
+        self.ema_network = self._create_ema_network(network, ema_network)
         self.noise_loss_tracker = keras.metrics.Mean(name="noise_loss")
         self.min_signal_rate = min_signal_rate
         self.max_signal_rate = max_signal_rate
         self.ema = ema
+        self._ema_update_function = None
+        # noise and times of training, a variable, so its state is checkpointed with the model
+        self.noise_generator = tf.random.Generator.from_seed(random.randint(0, 2**31 - 1))
         self.unet_data_input_shape = network.input[0].shape
+        # compiled sampling functions, keyed by the parameters they were traced for
+        self._sampling_functions = {}
 
     def get_config(self):
         config = super().get_config()
         config['min_signal_rate'] = self.min_signal_rate
         config['max_signal_rate'] = self.max_signal_rate
         config['ema'] = self.ema
+        config['ema_every'] = self.ema_every
+        config['ema_device'] = self.ema_device
+        config['accumulation_steps'] = self.accumulation_steps
         config['network'] = keras.saving.serialize_keras_object(self.network)
         config['ema_network'] = keras.saving.serialize_keras_object(self.ema_network)
         config['normalizer'] = keras.saving.serialize_keras_object(self.normalizer)
@@ -44,6 +65,71 @@ class DiffusionModel(keras.Model):
     def metrics(self):
         return [self.noise_loss_tracker]
 
+    @property
+    def trainable_weights(self):
+        # only the network is trained, the EMA network (and a distillation teacher) follow it;
+        # set explicitly, as sublayers built while loading the EMA network may come back trainable
+        return self.network.trainable_weights
+
+    @property
+    def trainable_variables(self):
+        return self.trainable_weights
+
+    def _ema_device_scope(self):
+        return tf.device(self.ema_device) if self.ema_device is not None else contextlib.nullcontext()
+
+    def _create_ema_network(self, network: keras.Model, ema_network: keras.Model = None) -> keras.Model:
+        """Returns the EMA network, starting as a copy of the network, placed on ema_device.
+        It's not trainable, so the optimizer doesn't track its weights."""
+        source = ema_network or network
+        if ema_network is None or self.ema_device is not None:
+            with self._ema_device_scope():
+                ema_network = keras.models.clone_model(source)
+            ema_network.set_weights(source.get_weights())
+        ema_network.trainable = False
+        return ema_network
+
+    def _update_ema(self):
+        """Move the EMA weights towards the network weights, every ema_every optimizer iterations.\n
+        Within a replica of a distribution strategy, the update is run from the cross-replica context,
+        as synchronization points can't be placed within control flow of a replica."""
+        if tf.distribute.has_strategy() and not tf.distribute.in_cross_replica_context():
+            tf.distribute.get_replica_context().merge_call(lambda strategy: self._update_ema())
+        elif self.ema_every == 1:
+            self._apply_ema_update()
+        else:
+            tf.cond(self.optimizer.iterations % self.ema_every == 0, self._apply_ema_update, lambda: None)
+
+    def _apply_ema_update(self):
+        """Update the EMA weights in a single XLA compiled function, so updates of all weights are fused
+        instead of running several small ops per weight.\n
+        With a distribution strategy, every device's copy of the EMA weights is updated from the same device's
+        copy of the network weights. Replicas hold equal weights after applying gradients, so the copies stay equal."""
+        if self._ema_update_function is None:
+            decay = self.ema ** self.ema_every
+
+            def update(weights, ema_weights):
+                for weight, ema_weight in zip(weights, ema_weights):
+                    ema_weight.assign_sub((1 - decay) * (ema_weight - tf.cast(weight, ema_weight.dtype)))
+
+            self._ema_update_function = tf.function(update, jit_compile=True)
+
+        if tf.distribute.has_strategy():
+            strategy = tf.distribute.get_strategy()
+            weights = [strategy.experimental_local_results(weight.value) for weight in self.network.weights]
+            ema_weights = [strategy.experimental_local_results(weight.value) for weight in self.ema_network.weights]
+            for i, device in enumerate(strategy.extended.worker_devices):
+                with tf.device(device):
+                    self._ema_update_function([weight[i] for weight in weights],
+                                              [weight[i] for weight in ema_weights])
+            return None
+
+        # network weights are passed as tensors, so they get copied to ema_device
+        weights = [weight.value for weight in self.network.weights]
+        with self._ema_device_scope():
+            self._ema_update_function(weights, [ema_weight.value for ema_weight in self.ema_network.weights])
+        return None
+
     @tf.function
     def _predict_noise(self, noisy_data: tf.Tensor, noise_powers: tf.Tensor, training: bool) -> tf.Tensor:
         """Takes noisy data and noise power, and attempts to predict the noise."""
@@ -52,9 +138,15 @@ class DiffusionModel(keras.Model):
         else:
             network = self.ema_network
 
-        pred_noises = network([noisy_data, noise_powers], training=training)
+        return self._run_network(network, noisy_data, noise_powers, training)
 
-        return pred_noises
+    @staticmethod
+    def _run_network(network: keras.Model, noisy_data: tf.Tensor, noise_powers: tf.Tensor,
+                     training: bool) -> tf.Tensor:
+        """Predict noise with network, in float32."""
+        pred_noises = network([noisy_data, noise_powers], training=training)
+        # with mixed precision the network predicts in float16/bfloat16, diffusion runs in float32
+        return tf.cast(pred_noises, tf.float32)
 
 #region utilities
 
@@ -87,29 +179,190 @@ class DiffusionModel(keras.Model):
 
 #endregion
 
-    def generate(self, diffusion_steps: int = 10, element_count: int = 1, seed: int = None, method: str = 'DDIM'
+    def generate(self, diffusion_steps: int = 10, element_count: int = 1, seed: int = None, method: str = 'DDIM',
+                 history: str = 'all', history_steps: int = 1, step_callback: Callable = None,
+                 diagnostics: bool = False, jit_compile: bool = False
                  ) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Generate data by reverse diffusion. Returns the generated data, and histories of predicted data,
+        predicted noises and noisy data, recorded according to history:
+        * 'all' - every step,
+        * 'every' - every history_steps-th step, counting back from the last step,
+        * 'last' - the last history_steps steps,
+        * 'none' - nothing, the histories are None.\n
+        Besides first-order 'DDIM' and 'DDPM', method may be one of the few-step solvers of the probability flow ODE:
+        multistep 'DPM++2M' and 'DPM++3M' (DPM-Solver++), and 'HEUN' (two network evaluations per step),
+        or the stochastic 'EULER-ANCESTRAL'. They usually need only 10-25 steps.\n
+        With step_callback, steps are run one at a time and the callback is called after every step with
+        (step, pred_data, pred_noises, noisy_data) as denormalized arrays. Histories are then not recorded.\n
+        With diagnostics, a dictionary of per-step statistics (see DIAGNOSTICS) is returned as a fifth element.
+        The statistics are only computed when requested.\n
+        Sampling functions are traced once per element_count, method, history, diagnostics and jit_compile;
+        diffusion_steps, seed and history_steps are passed as tensors, and random numbers are drawn with
+        stateless RNG, so the same seed gives the same result. With jit_compile, every step is compiled with XLA
+        (XLA draws different random numbers inside a step, so stochastic methods give different, but still
+        seed-determined, results than without it)."""
         seed = seed or random.randint(-100000000, 100000000)
 
-        pred_data, pred_data_history, pred_noises_history, noisy_data_history = \
-            self._generate_with_history(diffusion_steps=diffusion_steps, element_count=element_count, seed=seed, method=method)
+        if step_callback is not None:
+            pred_data, step_diagnostics = self._generate_with_callback(diffusion_steps, element_count, seed, method,
+                                                                       step_callback, diagnostics, jit_compile)
+            result = (self._denormalize(pred_data).numpy(), None, None, None)
+            return (*result, step_diagnostics) if diagnostics else result
 
-        pred_data = self._denormalize(pred_data)
-        pred_data_history = self._denormalize(pred_data_history)
-        pred_noises_history = self._denormalize(pred_noises_history)
-        noisy_data_history = self._denormalize(noisy_data_history)
-        return pred_data.numpy(), pred_data_history.numpy(), pred_noises_history.numpy(), noisy_data_history.numpy()
+        sampler = self._get_sampler(element_count, method, history, diagnostics, jit_compile)
+        pred_data, pred_data_history, pred_noises_history, noisy_data_history, step_diagnostics = \
+            sampler(diffusion_steps, seed, history_steps)
 
-    @tf.function
-    def _generate_with_history(self, diffusion_steps: int, element_count: int, seed: int, method: str):
-        input_shape = tf.constant(list(self.unet_data_input_shape)[1:])
-        target_shape = tf.concat([[int(element_count)], input_shape], axis=-1)
-        initial_noise = tf.random.normal(shape=target_shape, seed=seed)
+        pred_data = self._denormalize(pred_data).numpy()
+        if history == 'none':
+            result = (pred_data, None, None, None)
+        else:
+            pred_data_history = self._denormalize(pred_data_history)
+            pred_noises_history = self._denormalize(pred_noises_history)
+            noisy_data_history = self._denormalize(noisy_data_history)
+            result = (pred_data, pred_data_history.numpy(), pred_noises_history.numpy(), noisy_data_history.numpy())
 
-        pred_data, pred_data_history, pred_noises_history, noisy_data_history = \
-            self._reverse_diffusion_with_history(initial_noise, diffusion_steps, method)
+        if diagnostics:
+            return (*result, {name: value.numpy() for name, value in step_diagnostics.items()})
+        return result
 
-        return pred_data, pred_data_history, pred_noises_history, noisy_data_history
+    def _get_sampler(self, element_count: int, method: str, history: str, diagnostics: bool, jit_compile: bool):
+        """Returns a compiled function of (diffusion_steps, seed, history_steps), running the whole reverse diffusion."""
+        key = ('sampler', element_count, method, history, diagnostics, jit_compile)
+        if key not in self._sampling_functions:
+            step_function = self._get_step_function(method, diagnostics, jit_compile)
+
+            def sample(diffusion_steps, seed, history_steps):
+                initial_noise = self._initial_noise(element_count, seed)
+                return self._reverse_diffusion_with_history(initial_noise, diffusion_steps, seed, step_function,
+                                                            history, history_steps, diagnostics)
+
+            scalar = tf.TensorSpec(shape=[], dtype=tf.int32)
+            self._sampling_functions[key] = tf.function(sample, input_signature=[scalar, scalar, scalar])
+        return self._sampling_functions[key]
+
+    def _get_step_function(self, method: str, diagnostics: bool, jit_compile: bool):
+        """Returns a compiled _diffusion_step of (noisy_data, solver_state, step, diffusion_steps, seed)."""
+        key = ('step', method, diagnostics, jit_compile)
+        if key not in self._sampling_functions:
+            def step_function(noisy_data, solver_state, step, diffusion_steps, seed):
+                return self._diffusion_step(noisy_data, solver_state, step, diffusion_steps, seed, method, diagnostics)
+            self._sampling_functions[key] = tf.function(step_function, jit_compile=jit_compile, reduce_retracing=True)
+        return self._sampling_functions[key]
+
+    def generate_tiled(self, output_shape: tuple[int, ...], diffusion_steps: int = 10, element_count: int = 1,
+                       seed: int = None, method: str = 'DDIM', overlap: int | tuple[int, ...] = None,
+                       jit_compile: bool = False) -> np.ndarray:
+        """Generate data of output_shape (spatial dimensions, at least the network's input size),
+        by denoising overlapping tiles of the network's input size (MultiDiffusion).\n
+        The whole output is a single noisy tensor, so tiles share noise where they overlap. Every step,
+        all tiles are cut out of it and passed through the network in a single batch, and the predicted noises
+        of overlapping tiles are averaged, before the step of method is taken on the whole output.
+        The cost grows linearly with the area (volume) of the output.\n
+        Tiles overlap by at least overlap (per axis), by default a quarter of the tile size.
+        Returns only the generated data."""
+        seed = seed or random.randint(-100000000, 100000000)
+        tile_shape = tuple(self.unet_data_input_shape[1:-1])
+        output_shape = tuple(int(size) for size in output_shape)
+        if len(output_shape) != len(tile_shape):
+            raise ValueError(f'Output shape {output_shape} has to have the rank of tiles {tile_shape}.')
+        if overlap is None:
+            overlap = tuple(size // 4 for size in tile_shape)
+        elif isinstance(overlap, int):
+            overlap = (overlap,) * len(tile_shape)
+
+        sampler = self._get_tiled_sampler(output_shape, tuple(overlap), element_count, method, jit_compile)
+        pred_data = sampler(tf.constant(diffusion_steps, dtype=tf.int32), tf.constant(seed, dtype=tf.int32))
+        return self._denormalize(pred_data).numpy()
+
+    def _get_tiled_sampler(self, output_shape: tuple[int, ...], overlap: tuple[int, ...], element_count: int,
+                           method: str, jit_compile: bool):
+        """Returns a compiled function of (diffusion_steps, seed), running reverse diffusion over tiles."""
+        key = ('tiled', output_shape, overlap, element_count, method, jit_compile)
+        if key not in self._sampling_functions:
+            tile_shape = tuple(self.unet_data_input_shape[1:-1])
+            channels = self.unet_data_input_shape[-1]
+            tile_indices, counts = self._tile_indices(output_shape, tile_shape, overlap, element_count)
+
+            def predict_noise(noisy_data, noise_powers):
+                flat_data = tf.reshape(noisy_data, [-1, channels])
+                tiles = tf.gather(flat_data, tile_indices)
+                pred_noises = self._predict_noise(noisy_data=tiles, noise_powers=noise_powers, training=False)
+                summed = tf.math.unsorted_segment_sum(tf.reshape(pred_noises, [-1, channels]),
+                                                      tf.reshape(tile_indices, [-1]), num_segments=counts.shape[0])
+                return tf.reshape(summed / counts, tf.shape(noisy_data))
+
+            def step_function(noisy_data, solver_state, step, diffusion_steps, seed):
+                return self._diffusion_step(noisy_data, solver_state, step, diffusion_steps, seed, method,
+                                            predict_noise=predict_noise)
+            step_function = tf.function(step_function, jit_compile=jit_compile, reduce_retracing=True)
+
+            def sample(diffusion_steps, seed):
+                initial_noise = tf.random.stateless_normal(shape=[element_count, *output_shape, channels],
+                                                           seed=tf.stack([seed, 0]), alg='philox')
+                return self._reverse_diffusion_with_history(initial_noise, diffusion_steps, seed, step_function,
+                                                            history='none')[0]
+
+            scalar = tf.TensorSpec(shape=[], dtype=tf.int32)
+            self._sampling_functions[key] = tf.function(sample, input_signature=[scalar, scalar])
+        return self._sampling_functions[key]
+
+    @staticmethod
+    def _tile_indices(output_shape: tuple[int, ...], tile_shape: tuple[int, ...], overlap: tuple[int, ...],
+                      element_count: int) -> tuple[np.ndarray, np.ndarray]:
+        """Calculate indices of tile voxels into the flattened output of element_count elements,
+        of shape [element_count * tiles, *tile_shape], and how many tiles cover each voxel."""
+        axis_starts = []
+        for size, tile, axis_overlap in zip(output_shape, tile_shape, overlap):
+            if size < tile:
+                raise ValueError(f'Output shape {output_shape} is smaller than the tile shape {tile_shape}.')
+            if not 0 <= axis_overlap < tile:
+                raise ValueError(f'Overlap {overlap} has to be smaller than the tile shape {tile_shape}.')
+            # spread tiles evenly, so that neighbours overlap by at least the requested overlap
+            tile_count = -(-(size - tile) // (tile - axis_overlap)) + 1
+            axis_starts.append(np.linspace(0, size - tile, tile_count).round().astype(int))
+
+        voxel_count = int(np.prod(output_shape))
+        positions = np.arange(voxel_count).reshape(output_shape)
+        tiles = np.stack([positions[tuple(slice(start, start + tile) for start, tile in zip(starts, tile_shape))]
+                          for starts in itertools.product(*axis_starts)])
+        counts = np.bincount(tiles.ravel(), minlength=voxel_count).astype(np.float32)
+
+        element_offsets = np.arange(element_count).reshape(-1, *([1] * tiles.ndim)) * voxel_count
+        tile_indices = (element_offsets + tiles[None]).reshape(-1, *tile_shape).astype(np.int32)
+        return tile_indices, np.tile(counts, element_count)[:, None]
+
+    def _initial_noise(self, element_count: int, seed: tf.Tensor) -> tf.Tensor:
+        input_shape = tf.constant(list(self.unet_data_input_shape)[1:])
+        # element_count may be a tensor, for a batch size only known when sampling (see voxelnn.export)
+        target_shape = tf.concat([tf.reshape(tf.cast(element_count, tf.int32), [1]), input_shape], axis=-1)
+        return tf.random.stateless_normal(shape=target_shape, seed=tf.stack([seed, 0]), alg='philox')
+
+    def _generate_with_callback(self, diffusion_steps: int, element_count: int, seed: int, method: str,
+                                step_callback: Callable, diagnostics: bool, jit_compile: bool) -> tuple[tf.Tensor, dict]:
+        step_function = self._get_step_function(method, diagnostics, jit_compile)
+        seed = tf.constant(seed, dtype=tf.int32)
+        steps_tensor = tf.constant(diffusion_steps, dtype=tf.int32)
+        initial_noise = self._initial_noise(element_count, seed)
+        noisy_data = initial_noise
+        pred_data = tf.zeros_like(noisy_data)
+        solver_state = (pred_data, pred_data)
+        collected = {}
+        for step in range(diffusion_steps):
+            pred_data, pred_noises, noisy_data, solver_state, step_diagnostics = \
+                step_function(noisy_data, solver_state, tf.constant(step, dtype=tf.int32), steps_tensor, seed)
+            for name, value in step_diagnostics.items():
+                collected.setdefault(name, []).append(value.numpy())
+            step_callback(step,
+                          self._denormalize(pred_data).numpy(),
+                          self._denormalize(pred_noises).numpy(),
+                          self._denormalize(noisy_data).numpy())
+
+        if not diagnostics:
+            return pred_data, None
+        collected = {name: np.array(values) for name, values in collected.items()}
+        collected['initial_noise_variance'] = tf.math.reduce_variance(initial_noise).numpy()
+        return pred_data, collected
 
     @tf.function
     def _self_norm(self, data):
@@ -119,89 +372,188 @@ class DiffusionModel(keras.Model):
         result = (data - mean) / (var ** 0.5)
         return result
 
-    @tf.function
-    def _reverse_diffusion_with_history(self, initial_noise: tf.Tensor, diffusion_steps: int, method: str):
-        tf.print('method:', method)
-        step_size = 1.0 / float(diffusion_steps)
-
-        next_noisy_data = initial_noise
-        tf.print('initial_noise variance:', tf.math.reduce_variance(initial_noise))
+    # per-step statistics returned by generate(diagnostics=True)
+    DIAGNOSTICS = ('diffusion_times', 'noise_powers', 'signal_powers', 'next_noise_powers', 'next_signal_powers',
+                   'pred_noises_variance', 'pred_data_variance', 'noisy_data_variance')
+
+    def _diffusion_step(self, noisy_data: tf.Tensor, solver_state: tuple, step: tf.Tensor, diffusion_steps: tf.Tensor,
+                        seed: tf.Tensor, method: str, diagnostics: bool = False, predict_noise: Callable = None):
+        """Run a single reverse diffusion step. Returns predicted data, predicted noises, the next noisy data,
+        the next solver state (data predicted in the two previous steps, used by multistep methods),
+        and a dictionary of step statistics, empty unless diagnostics is set.\n
+        predict_noise(noisy_data, noise_powers) replaces the EMA network's prediction, if given."""
+        if predict_noise is None:
+            predict_noise = lambda noisy_data, noise_powers: \
+                self._predict_noise(noisy_data=noisy_data, noise_powers=noise_powers, training=False)
+        step_seed = tf.stack([seed, step + 1])
+        step_size = 1.0 / tf.cast(diffusion_steps, tf.float32)
+        step = tf.cast(step, tf.float32)
+
+        diffusion_times = tf.ones([1]) - step * step_size
+        signal_powers = self._cosine_diffusion_schedule(diffusion_times)
+        noise_powers = 1 - signal_powers
+        noise_power_sqrt = noise_powers ** 0.5
+        signal_power_sqrt = signal_powers ** 0.5
+
+        pred_noises = predict_noise(noisy_data, noise_powers)
+
+        next_diffusion_times = tf.ones([1]) - (step + 1) * step_size
+        next_signal_powers = self._cosine_diffusion_schedule(next_diffusion_times)
+        next_noise_powers = 1 - next_signal_powers
+        next_noise_power_sqrt = next_noise_powers ** 0.5
+        next_signal_power_sqrt = next_signal_powers ** 0.5
+
+        if method == 'DDIM':
+            pred_data = (noisy_data - (noise_power_sqrt * pred_noises)) / signal_power_sqrt
+            noisy_data = next_signal_power_sqrt * pred_data + next_noise_power_sqrt * pred_noises
+        elif method == 'DDIM-NORM':
+            pred_data = (noisy_data - (noise_power_sqrt * pred_noises)) / signal_power_sqrt
+            noisy_data = next_signal_power_sqrt * pred_data + next_noise_power_sqrt * pred_noises
+            noisy_data = next_signal_powers * noisy_data + next_noise_powers * self._self_norm(noisy_data)
+        elif method == 'DDPM':
+            sigma = ((next_noise_powers/noise_powers) ** 0.5) * ((noise_powers/next_signal_powers) ** 0.5)
+            pred_data = (noisy_data - (noise_power_sqrt * pred_noises)) / signal_power_sqrt
+            random_noise = tf.random.stateless_normal(shape=tf.shape(noisy_data), seed=step_seed, alg='philox')
+            noisy_data = next_signal_power_sqrt * pred_data + ((next_noise_powers * sigma ** 2) ** 0.5) * pred_noises + sigma * random_noise
+        elif method in ('DPM++2M', 'DPM++3M'):
+            pred_data = (noisy_data - (noise_power_sqrt * pred_noises)) / signal_power_sqrt
+            order = 2 if method == 'DPM++2M' else 3
+            noisy_data = self._dpm_solver_update(noisy_data, pred_data, solver_state, step, step_size, order)
+        elif method == 'HEUN':
+            pred_data = (noisy_data - (noise_power_sqrt * pred_noises)) / signal_power_sqrt
+            # Heun's method on the probability flow ODE of x / signal_rate,
+            # the Euler predictor is the DDIM step, the corrector averages the slopes (predicted noises)
+            euler_data = next_signal_power_sqrt * pred_data + next_noise_power_sqrt * pred_noises
+            next_pred_noises = predict_noise(euler_data, next_noise_powers)
+            noise_ratio_step = (next_noise_powers / next_signal_powers) ** 0.5 - (noise_powers / signal_powers) ** 0.5
+            noisy_data = next_signal_power_sqrt * (noisy_data / signal_power_sqrt
+                                                   + 0.5 * (pred_noises + next_pred_noises) * noise_ratio_step)
+            pred_noises = next_pred_noises
+            pred_data = (euler_data - (next_noise_power_sqrt * pred_noises)) / next_signal_power_sqrt
+        elif method == 'EULER-ANCESTRAL':
+            pred_data = (noisy_data - (noise_power_sqrt * pred_noises)) / signal_power_sqrt
+            # noise ratios are the noise levels of x / signal_rate
+            noise_ratio = (noise_powers / signal_powers) ** 0.5
+            next_noise_ratio = (next_noise_powers / next_signal_powers) ** 0.5
+            noise_ratio_up = tf.minimum(next_noise_ratio,
+                                        next_noise_ratio * (noise_ratio ** 2 - next_noise_ratio ** 2) ** 0.5 / noise_ratio)
+            noise_ratio_down = (next_noise_ratio ** 2 - noise_ratio_up ** 2) ** 0.5
+            random_noise = tf.random.stateless_normal(shape=tf.shape(noisy_data), seed=step_seed, alg='philox')
+            noisy_data = next_signal_power_sqrt * (pred_data + noise_ratio_down * pred_noises + noise_ratio_up * random_noise)
+        elif method == 'EXPERIMENTAL':
+            pred_data = (noisy_data - (noise_power_sqrt * pred_noises)) / signal_power_sqrt
+            noisy_data = next_signal_power_sqrt * pred_data - next_noise_power_sqrt * pred_noises
+        elif method == 'EXPERIMENTAL2':
+            pred_data = noisy_data - pred_noises * noise_power_sqrt
+            noisy_data = next_signal_power_sqrt * pred_data - next_noise_power_sqrt * pred_noises
+        elif method == 'EXPERIMENTAL3':
+            pred_data = (noisy_data - (noise_power_sqrt * pred_noises)) / signal_power_sqrt
+            noisy_data = next_signal_power_sqrt * pred_data - next_noise_power_sqrt * pred_noises
+        else:
+            raise Exception(f"Unknown method '{method}'!")
+
+        step_diagnostics = {}
+        if diagnostics:
+            step_diagnostics = {
+                'diffusion_times': diffusion_times[0],
+                'noise_powers': noise_powers[0],
+                'signal_powers': signal_powers[0],
+                'next_noise_powers': next_noise_powers[0],
+                'next_signal_powers': next_signal_powers[0],
+                'pred_noises_variance': tf.math.reduce_variance(pred_noises),
+                'pred_data_variance': tf.math.reduce_variance(pred_data),
+                'noisy_data_variance': tf.math.reduce_variance(noisy_data),
+            }
+
+        return pred_data, pred_noises, noisy_data, (pred_data, solver_state[0]), step_diagnostics
+
+    def _dpm_solver_update(self, noisy_data: tf.Tensor, pred_data: tf.Tensor, solver_state: tuple, step: tf.Tensor,
+                           step_size: tf.Tensor, order: int) -> tf.Tensor:
+        """DPM-Solver++ multistep update, without noise (k-diffusion's DPM++ 3M SDE with eta = 0).
+        Data predicted in the previous steps extrapolate the data prediction to the given order,
+        the first steps use the highest order their history allows."""
+        def half_log_snr(step_index):
+            signal_powers = self._cosine_diffusion_schedule(tf.ones([1]) - step_index * step_size)
+            return 0.5 * tf.math.log(signal_powers / (1 - signal_powers))
+
+        signal_powers = self._cosine_diffusion_schedule(tf.ones([1]) - step * step_size)
+        next_signal_powers = self._cosine_diffusion_schedule(tf.ones([1]) - (step + 1) * step_size)
+        noise_ratio = ((1 - next_signal_powers) / (1 - signal_powers)) ** 0.5
+
+        h = half_log_snr(step + 1) - half_log_snr(step)
+        phi_1 = -tf.math.expm1(-h)
+        phi_2 = 1 - phi_1 / h
+        phi_3 = phi_2 / h - 0.5
+        update = phi_1 * pred_data
+
+        if order >= 2:
+            previous_pred_data, second_previous_pred_data = solver_state
+            r0 = (half_log_snr(step) - half_log_snr(step - 1)) / h
+            d1_0 = (pred_data - previous_pred_data) / r0
+            update = tf.where(step >= 1, update + phi_2 * d1_0, update)
+            if order >= 3:
+                r1 = (half_log_snr(step - 1) - half_log_snr(step - 2)) / h
+                d1_1 = (previous_pred_data - second_previous_pred_data) / r1
+                d1 = d1_0 + (d1_0 - d1_1) * r0 / (r0 + r1)
+                d2 = (d1_0 - d1_1) / (r0 + r1)
+                update = tf.where(step >= 2, phi_1 * pred_data + phi_2 * d1 - phi_3 * d2, update)
+
+        return noise_ratio * noisy_data + next_signal_powers ** 0.5 * update
+
+    def _reverse_diffusion_with_history(self, initial_noise: tf.Tensor, diffusion_steps: tf.Tensor, seed: tf.Tensor,
+                                        step_function: Callable, history: str = 'all', history_steps: tf.Tensor = 1,
+                                        diagnostics: bool = False):
+        """Run the reverse diffusion loop, writing the steps selected by history
+        (and step statistics, with diagnostics) into TensorArrays."""
+        if history == 'all':
+            history_size, history_steps = diffusion_steps, 1
+        elif history == 'every':
+            history_size = (diffusion_steps + history_steps - 1) // history_steps
+        elif history == 'last':
+            history_size = tf.minimum(history_steps, diffusion_steps)
+        elif history == 'none':
+            history_size = 0
+        else:
+            raise Exception(f"Unknown history policy '{history}'!")
 
-        history_shape = tf.concat([[int(diffusion_steps)], initial_noise.shape], axis=-1)
-        pred_noises_history = tf.zeros(shape=history_shape)
-        pred_data_history = tf.zeros(shape=history_shape)
-        noisy_data_history = tf.zeros(shape=history_shape)
+        pred_noises_history = tf.TensorArray(tf.float32, size=history_size, element_shape=initial_noise.shape)
+        pred_data_history = tf.TensorArray(tf.float32, size=history_size, element_shape=initial_noise.shape)
+        noisy_data_history = tf.TensorArray(tf.float32, size=history_size, element_shape=initial_noise.shape)
+        diagnostics_history = {name: tf.TensorArray(tf.float32, size=diffusion_steps, element_shape=[])
+                               for name in (self.DIAGNOSTICS if diagnostics else ())}
 
-        pred_noises = tf.zeros(shape=initial_noise.shape)
-        pred_data = tf.zeros(shape=initial_noise.shape)
+        noisy_data = initial_noise
+        pred_data = tf.zeros_like(initial_noise)
+        solver_state = (pred_data, pred_data)
         for step in tf.range(diffusion_steps):
-            tf.print('step ', (step+1), " out of ", diffusion_steps)
-            noisy_data = next_noisy_data
-
-            diffusion_times = tf.ones([1]) - float(step) * step_size
-            tf.print('diffusion_times: ', diffusion_times)
-            signal_powers = self._cosine_diffusion_schedule(diffusion_times)
-            noise_powers = 1 - signal_powers
-            noise_power_sqrt = noise_powers ** 0.5
-            signal_power_sqrt = signal_powers ** 0.5
-            tf.print('noise_powers:', noise_powers, 'signal_powers:', signal_powers)
-
-            pred_noises = self._predict_noise(noisy_data=noisy_data, noise_powers=noise_powers, training=False)
-            tf.print('pred_noises variance:', tf.math.reduce_variance(pred_noises))
-
-            next_diffusion_times = tf.ones([1]) - float(step+1) * step_size
-            next_signal_powers = self._cosine_diffusion_schedule(next_diffusion_times)
-            next_noise_powers = 1 - next_signal_powers
-            next_noise_power_sqrt = next_noise_powers ** 0.5
-            next_signal_power_sqrt = next_signal_powers ** 0.5
-            tf.print('next_noise_powers:', next_noise_powers, 'next_signal_powers:', next_signal_powers)
-
-
-            if method == 'DDIM':
-                pred_data = (noisy_data - (noise_power_sqrt * pred_noises)) / signal_power_sqrt
-                tf.print('pred_data variance:', tf.math.reduce_variance(pred_data))
-                noisy_data = next_signal_power_sqrt * pred_data + next_noise_power_sqrt * pred_noises
-                tf.print('noisy_data variance:', tf.math.reduce_variance(pred_data))
-            elif method == 'DDIM-NORM':
-                pred_data = (noisy_data - (noise_power_sqrt * pred_noises)) / signal_power_sqrt
-                tf.print('pred_data variance:', tf.math.reduce_variance(pred_data))
-                noisy_data = next_signal_power_sqrt * pred_data + next_noise_power_sqrt * pred_noises
-                noisy_data = next_signal_powers * noisy_data + next_noise_powers * self._self_norm(noisy_data)
-                tf.print('noisy_data variance:', tf.math.reduce_variance(pred_data))
-            elif method == 'DDPM':
-                sigma = ((next_noise_powers/noise_powers) ** 0.5) * ((noise_powers/next_signal_powers) ** 0.5)
-                pred_data = (noisy_data - (noise_power_sqrt * pred_noises)) / signal_power_sqrt
-                random_noise = tf.random.normal(shape=initial_noise.shape)
-                noisy_data = next_signal_power_sqrt * pred_data + ((next_noise_powers * sigma ** 2) ** 0.5) * pred_noises + sigma * random_noise
-            elif method == 'EXPERIMENTAL':
-                pred_data = (noisy_data - (noise_power_sqrt * pred_noises)) / signal_power_sqrt
-                tf.print('pred_data variance:', tf.math.reduce_variance(pred_data))
-                noisy_data = next_signal_power_sqrt * pred_data - next_noise_power_sqrt * pred_noises
-                tf.print('noisy_data variance:', tf.math.reduce_variance(pred_data))
-            elif method == 'EXPERIMENTAL2':
-                pred_data = noisy_data - pred_noises * noise_power_sqrt
-                tf.print('pred_data variance:', tf.math.reduce_variance(pred_data))
-                noisy_data = next_signal_power_sqrt * pred_data - next_noise_power_sqrt * pred_noises
-                tf.print('noisy_data variance:', tf.math.reduce_variance(pred_data))
-            elif method == 'EXPERIMENTAL3':
-                pred_data = (noisy_data - (noise_power_sqrt * pred_noises)) / signal_power_sqrt
-                tf.print('pred_data variance:', tf.math.reduce_variance(pred_data))
-                noisy_data = next_signal_power_sqrt * pred_data - next_noise_power_sqrt * pred_noises
-                tf.print('noisy_data variance:', tf.math.reduce_variance(pred_data))
-            else:
-                raise Exception(f"Unknown method '{method}'!")
-
-            # update history here
-            indices = tf.reshape(step, [1,1])  # The iteration index
-            pred_noises_updates = tf.expand_dims(pred_noises, 0)
-            pred_noises_history = tf.tensor_scatter_nd_update(pred_noises_history, indices, pred_noises_updates)
-            pred_data_updates = tf.expand_dims(pred_data, 0)
-            pred_data_history = tf.tensor_scatter_nd_update(pred_data_history, indices, pred_data_updates)
-            noisy_data_updates = tf.expand_dims(noisy_data, 0)
-            noisy_data_history = tf.tensor_scatter_nd_update(noisy_data_history, indices, noisy_data_updates)
-            next_noisy_data = noisy_data
-
-        return pred_data, pred_data_history, pred_noises_history, noisy_data_history
+            pred_data, pred_noises, noisy_data, solver_state, step_diagnostics = \
+                step_function(noisy_data, solver_state, step, diffusion_steps, seed)
+
+            diagnostics_history = {name: values.write(step, step_diagnostics[name])
+                                   for name, values in diagnostics_history.items()}
+
+            if history != 'none':
+                if history == 'last':
+                    index = step - (diffusion_steps - history_size)
+                    is_recorded = index >= 0
+                else:
+                    steps_left = diffusion_steps - 1 - step
+                    index = history_size - 1 - steps_left // history_steps
+                    is_recorded = steps_left % history_steps == 0
+                if is_recorded:
+                    pred_noises_history = pred_noises_history.write(index, pred_noises)
+                    pred_data_history = pred_data_history.write(index, pred_data)
+                    noisy_data_history = noisy_data_history.write(index, noisy_data)
+
+        diagnostics_history = {name: values.stack() for name, values in diagnostics_history.items()}
+        if diagnostics:
+            diagnostics_history['initial_noise_variance'] = tf.math.reduce_variance(initial_noise)
+
+        if history == 'none':
+            return pred_data, None, None, None, diagnostics_history
+
+        return pred_data, pred_data_history.stack(), pred_noises_history.stack(), noisy_data_history.stack(), \
+            diagnostics_history
 
 #region training
 
@@ -210,28 +562,74 @@ class DiffusionModel(keras.Model):
         print(f'DiffusionModel: Learned data mean: {self.normalizer.mean}')
         print(f'DiffusionModel: Learned data variance: {self.normalizer.variance}')
 
-    @tf.function
+    def compute_loss(self, x=None, y=None, y_pred=None, sample_weight=None, training=True):
+        """The compiled loss between predicted and target noises (y_pred as returned by call),
+        averaged over the batch of this replica."""
+        pred_noises, noises = y_pred
+        return tf.reduce_mean(self.loss(noises, pred_noises))
+
     def train_step(self, data):
-        with tf.GradientTape() as tape:
-            pred_noises, noises = self(data, training=True)
+        data, _, _ = keras.utils.unpack_x_y_sample_weight(data)
+        if self.accumulation_steps > 1:
+            noise_loss, gradients = self._accumulate_gradients(data)
+        else:
+            with tf.GradientTape() as tape:
+                pred_noises, noises = self(data, training=True)
 
-            noise_loss = self.loss(noises, pred_noises)
+                noise_loss = self.compute_loss(y_pred=(pred_noises, noises))
+                # averaged over the global batch when distributed, then scaled with a LossScaleOptimizer
+                # (mixed_float16), which unscales the gradients when applying them
+                scaled_loss = self.optimizer.scale_loss(scale_loss_for_replicas(noise_loss))
 
-        gradients = tape.gradient(noise_loss, self.network.trainable_weights)
+            gradients = tape.gradient(scaled_loss, self.network.trainable_weights)
         self.optimizer.apply_gradients(zip(gradients, self.network.trainable_weights))
 
         self.noise_loss_tracker.update_state(noise_loss)
 
-        for weight, ema_weight in zip(self.network.weights, self.ema_network.weights):
-            ema_weight.assign(self.ema * ema_weight + (1 - self.ema) * weight)
+        self._update_ema()
 
         return {m.name: m.result() for m in self.metrics}
 
-    @tf.function
+    def _accumulate_gradients(self, data: tf.Tensor) -> Tuple[tf.Tensor, list]:
+        """Split the batch into accumulation_steps micro-batches and sum their gradients.
+        Returns the loss and the gradients of the whole batch.\n
+        Micro-batches run in a while loop without parallel iterations, so activations of only one are kept.
+        A batch which doesn't divide evenly (the last one of an epoch) is padded, the padding is masked out."""
+        steps = self.accumulation_steps
+        batch_size = tf.shape(data)[0]
+        micro_batch_size = (batch_size + steps - 1) // steps
+        padding = micro_batch_size * steps - batch_size
+        data = tf.pad(data, tf.concat([[[0, padding]], tf.zeros([tf.rank(data) - 1, 2], tf.int32)], axis=0))
+        micro_batches = tf.reshape(data, tf.concat([[steps, micro_batch_size], tf.shape(data)[1:]], axis=0))
+        micro_masks = tf.reshape(tf.pad(tf.ones([batch_size]), [[0, padding]]), [steps, micro_batch_size])
+        weights = self.network.trainable_weights
+
+        def accumulate(i, loss, gradients):
+            with tf.GradientTape() as tape:
+                pred_noises, noises = self(micro_batches[i], training=True)
+
+                losses = self.loss(noises, pred_noises)
+                element_losses = tf.reduce_mean(tf.reshape(losses, [micro_batch_size, -1]), axis=-1)
+                # the share of this micro-batch in the mean over the whole batch
+                micro_loss = tf.reduce_sum(element_losses * micro_masks[i]) / tf.cast(batch_size, tf.float32)
+                scaled_loss = self.optimizer.scale_loss(scale_loss_for_replicas(micro_loss))
+
+            micro_gradients = tape.gradient(scaled_loss, weights)
+            gradients = [gradient if micro_gradient is None else gradient + micro_gradient
+                         for gradient, micro_gradient in zip(gradients, micro_gradients)]
+            return i + 1, loss + micro_loss, gradients
+
+        _, loss, gradients = tf.while_loop(lambda i, loss, gradients: i < steps, accumulate,
+                                           (tf.constant(0), tf.constant(0.0),
+                                            [tf.zeros(weight.shape, weight.dtype) for weight in weights]),
+                                           parallel_iterations=1)
+        return loss, gradients
+
     def test_step(self, data):
+        data, _, _ = keras.utils.unpack_x_y_sample_weight(data)
         pred_noises, noises = self(data, training=False)
 
-        noise_loss = self.loss(noises, pred_noises)
+        noise_loss = self.compute_loss(y_pred=(pred_noises, noises), training=False)
 
         self.noise_loss_tracker.update_state(noise_loss)
 
@@ -243,8 +641,8 @@ class DiffusionModel(keras.Model):
             Returns tf.Tensor of predicted noise, predicted data, and the noise that was added."""
         normalized_data = self.normalizer(inputs, training=False)
         input_shape = tf.shape(normalized_data)
-        noises = tf.random.normal(shape=input_shape)
-        noise_powers = tf.random.uniform(
+        noises = self.noise_generator.normal(shape=input_shape)
+        noise_powers = self.noise_generator.uniform(
             shape=(input_shape[0],), minval=0.0, maxval=1.0
         )
         signal_powers = 1.0 - noise_powers
@@ -0,0 +1,118 @@
+"""This module contains a trainer class for progressive distillation of a diffusion model into fewer sampling steps."""
+
+from typing import Tuple
+import keras
+import tensorflow as tf
+from voxelnn.diffusion.diffusion_model import DiffusionModel
+
+@keras.saving.register_keras_serializable()
+class DistillationModel(DiffusionModel):
+    """Progressive distillation (Salimans & Ho, 2022): trains a student network to match two DDIM steps
+    of the teacher network with a single DDIM step, so the student samples in student_steps steps
+    what the teacher sampled in twice as many.\n
+    Train it like a DiffusionModel (compile with an optimizer and a noise loss, then fit), and sample
+    from the student with generate(diffusion_steps=student_steps, method='DDIM').
+    Repeat with next_round, halving the steps every round."""
+    def __init__(self, network: keras.Model, teacher_network: keras.Model, student_steps: int,
+                 name: str = "distillation_model", **kwargs):
+        super().__init__(network, name=name, **kwargs)
+        self.teacher_network = teacher_network
+        self.teacher_network.trainable = False
+        self.student_steps = student_steps
+
+    def get_config(self):
+        config = super().get_config()
+        config['student_steps'] = self.student_steps
+        config['teacher_network'] = keras.saving.serialize_keras_object(self.teacher_network)
+        return config
+
+    @classmethod
+    def from_config(cls, config):
+        config['teacher_network'] = keras.layers.deserialize(config['teacher_network'])
+        return super().from_config(config)
+
+    @classmethod
+    def from_teacher(cls, teacher: DiffusionModel, teacher_steps: int, **kwargs) -> 'DistillationModel':
+        """Create a student sampling in half of teacher_steps. The teacher's EMA network is the teacher,
+        the student and its EMA start as copies of it. The normalizer is shared with the teacher."""
+        if teacher_steps < 2 or teacher_steps % 2 != 0:
+            raise ValueError(f'Teacher steps have to be an even number, got {teacher_steps}.')
+
+        def copy_network(network, trainable=False):
+            result = keras.models.clone_model(network)
+            result.set_weights(network.get_weights())
+            # the EMA network isn't trainable, and its clone keeps that per layer
+            for layer in result.layers:
+                layer.trainable = trainable
+            return result
+
+        return cls(copy_network(teacher.ema_network, trainable=True),
+                   teacher_network=copy_network(teacher.ema_network),
+                   student_steps=teacher_steps // 2,
+                   ema_network=copy_network(teacher.ema_network),
+                   normalizer=teacher.normalizer,
+                   min_signal_rate=teacher.min_signal_rate,
+                   max_signal_rate=teacher.max_signal_rate,
+                   ema=teacher.ema,
+                   **kwargs)
+
+    def next_round(self, **kwargs) -> 'DistillationModel':
+        """Create the student of the next round, with this student as the teacher."""
+        return type(self).from_teacher(self, self.student_steps, **kwargs)
+
+    def to_diffusion_model(self) -> DiffusionModel:
+        """Returns a DiffusionModel of the student only, without the teacher network."""
+        return DiffusionModel(self.network, ema_network=self.ema_network, normalizer=self.normalizer,
+                              min_signal_rate=self.min_signal_rate, max_signal_rate=self.max_signal_rate,
+                              ema=self.ema)
+
+    def _ddim_step(self, noisy_data, diffusion_times, next_diffusion_times):
+        """A DDIM step of the teacher, with a diffusion time per element."""
+        signal_powers = self._cosine_diffusion_schedule(diffusion_times)
+        next_signal_powers = self._cosine_diffusion_schedule(next_diffusion_times)
+        signal_rates = self._reshape_1d_for_data(signal_powers ** 0.5, noisy_data)
+        noise_rates = self._reshape_1d_for_data((1 - signal_powers) ** 0.5, noisy_data)
+        next_signal_rates = self._reshape_1d_for_data(next_signal_powers ** 0.5, noisy_data)
+        next_noise_rates = self._reshape_1d_for_data((1 - next_signal_powers) ** 0.5, noisy_data)
+
+        pred_noises = self._run_network(self.teacher_network, noisy_data, 1 - signal_powers, training=False)
+        pred_data = (noisy_data - noise_rates * pred_noises) / signal_rates
+        return next_signal_rates * pred_data + next_noise_rates * pred_noises
+
+    @tf.function
+    def call(self, inputs, training=False) -> Tuple[tf.Tensor, tf.Tensor]:
+        """Noises data at random student step times, then predicts noise with the student.
+        Returns tf.Tensor of predicted noise, and the noise for which a single DDIM step of the student
+        ends where two DDIM steps of the teacher do."""
+        normalized_data = self.normalizer(inputs, training=False)
+        input_shape = tf.shape(normalized_data)
+        noises = self.noise_generator.normal(shape=input_shape)
+
+        # times of the sampling steps, as generate(diffusion_steps=student_steps) runs them
+        step_size = 1.0 / self.student_steps
+        steps = self.noise_generator.uniform(shape=(input_shape[0],), minval=1, maxval=self.student_steps + 1,
+                                             dtype=tf.int32)
+        diffusion_times = tf.cast(steps, tf.float32) * step_size
+        next_diffusion_times = diffusion_times - step_size
+
+        signal_powers = self._cosine_diffusion_schedule(diffusion_times)
+        noise_powers = 1 - signal_powers
+        next_signal_powers = self._cosine_diffusion_schedule(next_diffusion_times)
+        signal_rates = self._reshape_1d_for_data(signal_powers ** 0.5, normalized_data)
+        noise_rates = self._reshape_1d_for_data(noise_powers ** 0.5, normalized_data)
+        next_signal_rates = self._reshape_1d_for_data(next_signal_powers ** 0.5, normalized_data)
+        next_noise_rates = self._reshape_1d_for_data((1 - next_signal_powers) ** 0.5, normalized_data)
+        noisy_data = signal_rates * normalized_data + noise_rates * noises
+
+        teacher_data = self._ddim_step(noisy_data, diffusion_times, diffusion_times - 0.5 * step_size)
+        teacher_data = self._ddim_step(teacher_data, diffusion_times - 0.5 * step_size, next_diffusion_times)
+
+        # solve the student's DDIM step for the data prediction reaching teacher_data, then for the noise
+        noise_ratios = next_noise_rates / noise_rates
+        target_data = (teacher_data - noise_ratios * noisy_data) / (next_signal_rates - noise_ratios * signal_rates)
+        target_noises = (noisy_data - signal_rates * target_data) / noise_rates
+        target_noises = tf.stop_gradient(target_noises)
+
+        pred_noises = self._predict_noise(noisy_data=noisy_data, noise_powers=noise_powers, training=training)
+
+        return pred_noises, target_noises
@@ -3,9 +3,11 @@
 import tensorflow as tf
 import keras
 from keras import layers
-from voxelnn.diffusion.custom_layers import TimeEmbedding
+from voxelnn.diffusion.custom_layers import AxialAttention, ChunkedAttention, TimeEmbedding, WindowAttention
 from voxelnn.diffusion.utils import kernel_init
 
+ATTENTION_TYPES = ('full', 'window', 'axial', 'chunked')
+
 def build_model(
     input_shape: tuple[int, ...],
     latent_dims: int,
@@ -16,11 +18,37 @@ def build_model(
     first_conv_channels: int = 32,
     time_embedding_dims: int = 32,
     min_time_emb_frequency: float = 1.0,
-    max_time_emb_frequency: float = 1000.0):
-    
+    max_time_emb_frequency: float = 1000.0,
+    layer_attn_types: list[str] = None,
+    attn_window_size: int = 8,
+    attn_chunk_size: int = 1024):
+    """Attention of every level (with layer_attn_heads above 0) is one of:
+    * 'full' - over all spatial positions, the default; scores for all pairs of positions take
+    (H*W)^2 or (D*H*W)^2 memory,
+    * 'window' - within windows of attn_window_size positions along every spatial axis,
+    * 'axial' - along each spatial axis in turn, so information is still exchanged between all positions,
+    * 'chunked' - over all spatial positions, for attn_chunk_size queries at a time."""
+
     is3d = len(input_shape) == 3
+    spatial_axes = (1, 2, 3) if is3d else (1, 2)
+    layer_attn_types = layer_attn_types or ['full'] * len(layer_units)
+    for attn_type in layer_attn_types:
+        if attn_type not in ATTENTION_TYPES:
+            raise ValueError(f"Unknown attention type '{attn_type}', expected one of {ATTENTION_TYPES}.")
+
+    def _Attention(units: int, attn_heads: int, attn_type: str):
+        def apply(x):
+            if attn_type == 'window':
+                return WindowAttention(num_heads=attn_heads, key_dim=units, window_size=attn_window_size)(x)
+            if attn_type == 'chunked':
+                return ChunkedAttention(num_heads=attn_heads, key_dim=units, chunk_size=attn_chunk_size)(x)
+            if attn_type == 'axial':
+                return AxialAttention(num_heads=attn_heads, key_dim=units)(x)
+            return layers.MultiHeadAttention(num_heads=attn_heads, key_dim=units, attention_axes=spatial_axes)(x, x)
+
+        return apply
 
-    def _ResidualBlock(units: int, attn_heads: int):
+    def _ResidualBlock(units: int, attn_heads: int, attn_type: str):
         def apply(inputs):
             x, time_embedding = inputs
             input_width = x.shape[4] if is3d else x.shape[3]
@@ -43,10 +71,7 @@ def build_model(
             if attn_heads != 0:
                 residual = x
                 x = layers.GroupNormalization(groups=norm_groups, center=False, scale=False)(x)
-                if is3d:
-                    x = layers.MultiHeadAttention(num_heads=attn_heads, key_dim=units, attention_axes=(1, 2))(x, x)
-                else:
-                    x = layers.MultiHeadAttention(num_heads=attn_heads, key_dim=units, attention_axes=(1, 2, 3))(x, x)
+                x = _Attention(units, attn_heads, attn_type)(x)
                 x = layers.Add()([residual, x])
 
             return x
@@ -76,13 +101,13 @@ def build_model(
 
         return apply
 
-    def _DownBlock(block_depth, units, attn_heads):
+    def _DownBlock(block_depth, units, attn_heads, attn_type):
         def apply(x):
             print("UNET: Adding down block")
             x, n, skips = x
             for i in range(block_depth):
                 print(f"UNET: Adding residual block {i+1} in down block")
-                x = _ResidualBlock(units, attn_heads)([x, n])
+                x = _ResidualBlock(units, attn_heads, attn_type)([x, n])
                 skips.append(x)
             if is3d:
                 x = layers.AveragePooling3D(pool_size=2)(x)
@@ -92,7 +117,7 @@ def build_model(
 
         return apply
 
-    def _UpBlock(block_depth, units, attn_heads):
+    def _UpBlock(block_depth, units, attn_heads, attn_type):
         def apply(x):
             print("UNET: Adding up block")
             x, n, skips = x
@@ -104,7 +129,7 @@ def build_model(
             for i in range(block_depth):
                 print(f"UNET: Adding residual block {i+1} in up block")
                 x = layers.Concatenate()([x, skips.pop()])
-                x = _ResidualBlock(units, attn_heads)([x, n])
+                x = _ResidualBlock(units, attn_heads, attn_type)([x, n])
             return x
 
         return apply
@@ -129,29 +154,34 @@ def build_model(
     time_embedding = layers.Dense(time_embedding_dims, activation=keras.activations.swish, kernel_initializer=kernel_init(1.0))(time_embedding)
 
     skips = [x]
-    for res_blocks, units, attn_heads in zip(layer_res_blocks[:-1],
-                                                layer_units[:-1],
-                                                layer_attn_heads[:-1]):
-        x = _DownBlock(block_depth=res_blocks, units=units, attn_heads=attn_heads)([x, time_embedding, skips])
+    for res_blocks, units, attn_heads, attn_type in zip(layer_res_blocks[:-1],
+                                                        layer_units[:-1],
+                                                        layer_attn_heads[:-1],
+                                                        layer_attn_types[:-1]):
+        x = _DownBlock(block_depth=res_blocks, units=units, attn_heads=attn_heads,
+                       attn_type=attn_type)([x, time_embedding, skips])
 
     print('UNET: Adding middle block')
     units = layer_units[-1]
     res_blocks = layer_res_blocks[-1]
     attn_heads = layer_attn_heads[-1]
+    attn_type = layer_attn_types[-1]
     for i in range(res_blocks):
         print(f"UNET: Adding residual block {(i+1)} in the middle")
-        x = _ResidualBlock(units=units, attn_heads=attn_heads)([x, time_embedding])
+        x = _ResidualBlock(units=units, attn_heads=attn_heads, attn_type=attn_type)([x, time_embedding])
 
-    for res_blocks, units, attn_heads in zip(layer_res_blocks[-2::-1],
-                                                layer_units[-2::-1],
-                                                layer_attn_heads[-2::-1]):
-        x = _UpBlock(block_depth=res_blocks, units=units, attn_heads=attn_heads)([x, time_embedding, skips])
+    for res_blocks, units, attn_heads, attn_type in zip(layer_res_blocks[-2::-1],
+                                                        layer_units[-2::-1],
+                                                        layer_attn_heads[-2::-1],
+                                                        layer_attn_types[-2::-1]):
+        x = _UpBlock(block_depth=res_blocks, units=units, attn_heads=attn_heads,
+                     attn_type=attn_type)([x, time_embedding, skips])
 
     # End layer
     print('UNET: Adding end layer')
     x = layers.GroupNormalization(groups=norm_groups)(x)
     x = keras.activations.swish(x)
-    x = _ResidualBlock(units=layer_units[0], attn_heads=attn_heads)([x, time_embedding])
+    x = _ResidualBlock(units=layer_units[0], attn_heads=attn_heads, attn_type=attn_type)([x, time_embedding])
     x = _conv(filters=latent_dims, kernel_size=1, padding="same", kernel_initializer=kernel_init(0.0))(x)
 
     assert (x.shape == data_input.shape), "output shape not equal to input shape"
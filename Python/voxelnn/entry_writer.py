@@ -0,0 +1,127 @@
+"""Streaming export of entries as EntryDTO JSON, in the format the Unity tool reads.\n
+Entries are written one at a time into shards of bounded size, each a JSON array byte-for-byte equal to
+json.dumps of the construct_entry_dto dictionaries of its entries. Blocks are formatted from the NumPy array
+directly, without building a list of Python ints."""
+
+import gzip
+import json
+import os
+import numpy as np
+
+_DIGITS = np.frombuffer(b'0123456789', dtype=np.uint8)
+_SEPARATOR = np.frombuffer(b', ', dtype=np.uint8)
+
+
+def format_blocks(blocks: np.ndarray) -> bytes:
+    """Returns the JSON array of blocks (non-negative integers) in C order, as json.dumps formats a list."""
+    values = np.ascontiguousarray(blocks).ravel()
+    if values.size == 0:
+        return b'[]'
+    values = values.astype(np.int64 if values.dtype.itemsize > 4 else np.uint32)
+    width = len(str(int(values.max())))
+
+    # every value right-aligned in width digits, followed by the separator; digits before the first
+    # significant one (except a lone 0) and the last separator are dropped
+    chars = np.empty((values.size, width + len(_SEPARATOR)), dtype=np.uint8)
+    keep = np.ones(chars.shape, dtype=bool)
+    remaining = values.copy()
+    for column in range(width - 1, -1, -1):
+        chars[:, column] = _DIGITS[remaining % 10]
+        remaining //= 10
+    for column in range(width - 1):
+        keep[:, column] = values >= 10 ** (width - 1 - column)
+    chars[:, width:] = _SEPARATOR
+    keep[-1, width:] = False
+    return b'[' + chars[keep].tobytes() + b']'
+
+
+def format_entry(friendly_name: str, tag_names: list, tags_multilabel: np.ndarray, block_names: list,
+                 blocks: np.ndarray) -> bytes:
+    """Returns the JSON of construct_entry_dto with the same arguments."""
+    tags = [name for name, value in zip(tag_names, tags_multilabel) if value == 1]
+    return b''.join([
+        b'{"FriendlyName": ', json.dumps(friendly_name).encode('ascii'),
+        b', "Tags": ', json.dumps(tags).encode('ascii'),
+        b', "Dimensions": ', json.dumps(list(blocks.shape)).encode('ascii'),
+        b', "BlockNames": ', json.dumps(list(block_names)).encode('ascii'),
+        b', "Blocks": ', format_blocks(blocks), b'}',
+    ])
+
+
+class EntryWriter:
+    """Writes entries into JSON shards of at most max_shard_bytes (uncompressed; an entry larger than that
+    gets a shard of its own), named path_prefix-00000.json, path_prefix-00001.json, ...
+    With compress, shards are gzipped (.json.gz) and have to be decompressed for the Unity tool.\n
+    Every shard is written to a .partial file, which is renamed once the shard is complete, so only
+    complete shards ever exist under their names. Use as a context manager, or call close (or abort)."""
+    def __init__(self, path_prefix: str, tag_names: list, block_names: list, max_shard_bytes: int = 64 << 20,
+                 compress: bool = False):
+        self.path_prefix = path_prefix
+        self.tag_names = list(tag_names)
+        self.block_names = list(block_names)
+        self.max_shard_bytes = max_shard_bytes
+        self.compress = compress
+        self.paths = []
+        self.entry_count = 0
+        self._file = None
+        self._shard_bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def _open_shard(self):
+        path = f'{self.path_prefix}-{len(self.paths):05d}.json' + ('.gz' if self.compress else '')
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.paths.append(path)
+        if self.compress:
+            # no timestamp in the header, so the same entries give the same file
+            self._file = gzip.GzipFile(path + '.partial', 'wb', mtime=0)
+        else:
+            self._file = open(path + '.partial', 'wb')
+        self._file.write(b'[')
+        self._shard_bytes = 2
+
+    def _close_shard(self):
+        self._file.write(b']')
+        self._file.close()
+        self._file = None
+        os.replace(self.paths[-1] + '.partial', self.paths[-1])
+
+    def write(self, friendly_name: str, tags_multilabel: np.ndarray, blocks: np.ndarray):
+        """Write an entry, taking the same arguments as construct_entry_dto, besides the names."""
+        entry = format_entry(friendly_name, self.tag_names, tags_multilabel, self.block_names, blocks)
+        if self._file is not None and self._shard_bytes + len(b', ') + len(entry) > self.max_shard_bytes:
+            self._close_shard()
+        if self._file is None:
+            self._open_shard()
+        else:
+            self._file.write(b', ')
+            self._shard_bytes += len(b', ')
+        self._file.write(entry)
+        self._shard_bytes += len(entry)
+        self.entry_count += 1
+
+    def close(self) -> list[str]:
+        """Complete the last shard. Returns the paths of all shards, a single empty one if no entry
+        was written."""
+        if self._file is None and not self.paths:
+            self._open_shard()
+        if self._file is not None:
+            self._close_shard()
+        return self.paths
+
+    def abort(self):
+        """Delete the incomplete shard, leaving only the completed ones. Called on an exception in the
+        with block."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            os.remove(self.paths.pop() + '.partial')
@@ -0,0 +1,207 @@
+"""Exporting the generator for production, without the training code.\n
+export_saved_model writes the EMA U-Net, the decoder and the sampling loop as one SavedModel with a
+`generate(count, steps, seed)` signature returning block IDs:
+`tf.saved_model.load(path).generate(count=4, steps=25, seed=1)['blocks']`.\n
+export_tflite writes the U-Net and the decoder as int8 post-training-quantized TFLite models, calibrated on
+latents of the dataset, for voxelnn.tflite_generator.TFLiteGenerator.
+check_parity compares both with the float model.\n
+Run with `python -m voxelnn.export diffusion.keras decoder.keras export_dir --latents z_mean.npy --check-parity`,
+where the latents are the z_mean of the dataset, as stored by LatentCache."""
+
+import argparse
+import json
+import os
+import tempfile
+import keras
+import numpy as np
+import tensorflow as tf
+from voxelnn import tflite_generator
+from voxelnn.coding.decoding import decode_to_blocks, logits_model
+from voxelnn.dataset_storage import block_dtype_for
+# register the custom objects needed to load the models
+import voxelnn.coding.custom_layers # pylint: disable=unused-import
+import voxelnn.diffusion.custom_layers # pylint: disable=unused-import
+import voxelnn.diffusion.diffusion_model # pylint: disable=unused-import
+
+SAVED_MODEL_DIRECTORY = 'generator'
+
+
+def export_saved_model(diffusion_model, decoder: keras.Model, path: str, method: str = 'DDIM'):
+    """Write a SavedModel with a generate(count, steps, seed) signature of int32 scalars, returning
+    {'blocks': block IDs} of count elements, sampled with method.\n
+    Sampling is the same as diffusion_model.generate with history='none' followed by decode_to_blocks,
+    so for the same seed the result is the same."""
+    decoder_logits, _ = logits_model(decoder)
+    block_dtype = tf.as_dtype(block_dtype_for(decoder.output.shape[-1]))
+
+    def step_function(noisy_data, solver_state, step, diffusion_steps, seed):
+        return diffusion_model._diffusion_step(noisy_data, solver_state, step, diffusion_steps, seed, method) # pylint: disable=protected-access
+
+    def generate(count, steps, seed):
+        initial_noise = diffusion_model._initial_noise(count, seed) # pylint: disable=protected-access
+        pred_data = diffusion_model._reverse_diffusion_with_history( # pylint: disable=protected-access
+            initial_noise, steps, seed, step_function, history='none')[0]
+        outputs = decoder_logits(diffusion_model._denormalize(pred_data), training=False) # pylint: disable=protected-access
+        return {'blocks': tf.cast(tf.argmax(outputs, axis=-1), block_dtype)}
+
+    archive = keras.export.ExportArchive()
+    archive.track(diffusion_model.ema_network)
+    archive.track(decoder_logits)
+    scalar = tf.TensorSpec(shape=[], dtype=tf.int32)
+    # a tf.function, for AutoGraph to convert the sampling loop
+    archive.add_endpoint('generate', tf.function(generate, input_signature=[scalar, scalar, scalar]))
+    archive.write_out(path, verbose=False)
+
+
+def _check_tflite_attention(network: keras.Model):
+    """Full attention over 2 or 3 spatial axes transposes 7D or 8D tensors, TFLite kernels support up to 6D."""
+    for layer in network._flatten_layers(): # pylint: disable=protected-access
+        attention_axes = getattr(layer, '_attention_axes', None)
+        if isinstance(layer, keras.layers.MultiHeadAttention) and len(attention_axes) > 1:
+            raise ValueError(f"Layer '{layer.name}' attends over {len(attention_axes)} axes at once, which TFLite "
+                             "can't run; build the U-Net with 'window', 'axial' or 'chunked' attention "
+                             "(layer_attn_types) to export it to TFLite.")
+
+
+def _convert(function, models: list[keras.Model], input_signature: list, representative_dataset,
+             int8: bool) -> bytes:
+    """Convert a function of models to a TFLite model, through a temporary SavedModel."""
+    archive = keras.export.ExportArchive()
+    for model in models:
+        archive.track(model)
+    archive.add_endpoint('serve', function, input_signature=input_signature)
+    with tempfile.TemporaryDirectory() as path:
+        archive.write_out(path, verbose=False)
+        converter = tf.lite.TFLiteConverter.from_saved_model(path, signature_keys=['serve'])
+        if int8:
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+            converter.representative_dataset = representative_dataset
+            # int8 kernels where there are, float for the rest
+            converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8,
+                                                   tf.lite.OpsSet.TFLITE_BUILTINS]
+        return converter.convert()
+
+
+def export_tflite(diffusion_model, decoder: keras.Model, directory: str, latents: np.ndarray,
+                  calibration_samples: int = 200, int8: bool = True, seed: int = 0):
+    """Write the EMA U-Net and the decoder (argmax included) as TFLite models, with the configuration of the
+    sampling loop, for TFLiteGenerator.\n
+    With int8, weights and activations are quantized to int8. The U-Net is calibrated on calibration_samples
+    latents, normalized and noised at random times of the diffusion schedule, the decoder on the latents."""
+    network = diffusion_model.ema_network
+    _check_tflite_attention(network)
+    data_shape = list(diffusion_model.unet_data_input_shape)[1:]
+    decoder_logits, _ = logits_model(decoder)
+    block_dtype = block_dtype_for(decoder.output.shape[-1])
+
+    rng = np.random.default_rng(seed)
+    latents = np.asarray(latents[rng.choice(latents.shape[0], min(calibration_samples, latents.shape[0]),
+                                            replace=False)], dtype=np.float32)
+    normalized = diffusion_model.normalizer(latents, training=False).numpy()
+    diffusion_times = rng.uniform(size=latents.shape[0]).astype(np.float32)
+    signal_powers = diffusion_model._cosine_diffusion_schedule(diffusion_times).numpy() # pylint: disable=protected-access
+    rates_shape = (-1, *([1] * len(data_shape)))
+    noisy_latents = signal_powers.reshape(rates_shape) ** 0.5 * normalized \
+        + (1 - signal_powers).reshape(rates_shape) ** 0.5 * rng.standard_normal(normalized.shape).astype(np.float32)
+
+    def unet_dataset():
+        for noisy_data, signal_power in zip(noisy_latents, signal_powers):
+            yield {'noisy_data': noisy_data[None], 'noise_powers': np.array([1 - signal_power], dtype=np.float32)}
+
+    def decoder_dataset():
+        for latent in latents:
+            yield {'latents': latent[None]}
+
+    def predict_noise(noisy_data, noise_powers):
+        return tf.cast(network([noisy_data, noise_powers], training=False), tf.float32)
+
+    def decode(latents):
+        return tf.cast(tf.argmax(decoder_logits(latents, training=False), axis=-1), tf.int32)
+
+    os.makedirs(directory, exist_ok=True)
+    data_spec = tf.TensorSpec(shape=[None, *data_shape], dtype=tf.float32)
+    models = {
+        tflite_generator.UNET_FILE: (predict_noise, network,
+                                     [data_spec, tf.TensorSpec(shape=[None], dtype=tf.float32)], unet_dataset),
+        tflite_generator.DECODER_FILE: (decode, decoder_logits, [data_spec], decoder_dataset),
+    }
+    for file_name, (function, model, input_signature, dataset) in models.items():
+        with open(os.path.join(directory, file_name), 'wb') as file:
+            file.write(_convert(function, [model], input_signature, dataset, int8))
+
+    config = {
+        'data_shape': data_shape,
+        'min_signal_rate': float(diffusion_model.min_signal_rate),
+        'max_signal_rate': float(diffusion_model.max_signal_rate),
+        'mean': np.asarray(diffusion_model.normalizer.mean).tolist(),
+        'variance': np.asarray(diffusion_model.normalizer.variance).tolist(),
+        'block_dtype': block_dtype.name,
+    }
+    with open(os.path.join(directory, tflite_generator.CONFIG_FILE), 'w', encoding='utf-8') as file:
+        json.dump(config, file, indent=2)
+
+
+def _float_generate(diffusion_model, decoder: keras.Model, count: int, steps: int, seed: int,
+                    method: str) -> tuple[np.ndarray, np.ndarray]:
+    latents = diffusion_model.generate(diffusion_steps=steps, element_count=count, seed=seed, method=method,
+                                       history='none')[0]
+    return latents, decode_to_blocks(decoder, latents)
+
+
+def check_parity(diffusion_model, decoder: keras.Model, directory: str, count: int = 8, steps: int = 25,
+                 seed: int = 1, method: str = 'DDIM') -> dict:
+    """Generate count elements with the float model, the exported SavedModel (sampling with method)
+    and the TFLite models (DDIM), if exported, from the same initial noise.
+    Returns the fraction of voxels with the same block as the float model,
+    and for TFLite the RMSE of latents relative to their stddev."""
+    results = {}
+    saved_model_path = os.path.join(directory, SAVED_MODEL_DIRECTORY)
+    if os.path.isdir(saved_model_path):
+        _, blocks = _float_generate(diffusion_model, decoder, count, steps, seed, method)
+        generator = tf.saved_model.load(saved_model_path)
+        saved_model_blocks = generator.generate(count=count, steps=steps, seed=seed)['blocks'].numpy()
+        results['saved_model_block_agreement'] = float(np.mean(saved_model_blocks == blocks))
+
+    if os.path.isfile(os.path.join(directory, tflite_generator.UNET_FILE)):
+        latents, blocks = _float_generate(diffusion_model, decoder, count, steps, seed, 'DDIM')
+        generator = tflite_generator.TFLiteGenerator(directory)
+        initial_noise = diffusion_model._initial_noise(count, tf.constant(seed, dtype=tf.int32)).numpy() # pylint: disable=protected-access
+        tflite_latents = generator.generate_latents(steps=steps, initial_noise=initial_noise)
+        results['tflite_block_agreement'] = float(np.mean(generator.decode(tflite_latents) == blocks))
+        results['tflite_latent_relative_rmse'] = float(np.sqrt(np.mean((tflite_latents - latents) ** 2))
+                                                       / np.std(latents))
+    return results
+
+
+def _main():
+    parser = argparse.ArgumentParser(description='Export the generator as a SavedModel, and optionally TFLite.')
+    parser.add_argument('diffusion_model', help='saved DiffusionModel (.keras)')
+    parser.add_argument('decoder', help='saved decoder (.keras)')
+    parser.add_argument('output', help='output directory')
+    parser.add_argument('--method', default='DDIM', help='sampling method of the SavedModel')
+    parser.add_argument('--latents', default=None,
+                        help='.npy of dataset latents, to calibrate the int8 TFLite models (exported if given)')
+    parser.add_argument('--calibration-samples', type=int, default=200)
+    parser.add_argument('--check-parity', action='store_true', help='compare the exports with the float model')
+    parser.add_argument('--parity-count', type=int, default=8)
+    parser.add_argument('--parity-steps', type=int, default=25)
+    args = parser.parse_args()
+
+    diffusion_model = keras.models.load_model(args.diffusion_model)
+    decoder = keras.models.load_model(args.decoder)
+
+    export_saved_model(diffusion_model, decoder, os.path.join(args.output, SAVED_MODEL_DIRECTORY), args.method)
+    print(f'Exported the SavedModel to {os.path.join(args.output, SAVED_MODEL_DIRECTORY)}')
+    if args.latents is not None:
+        export_tflite(diffusion_model, decoder, args.output, np.load(args.latents, mmap_mode='r'),
+                      args.calibration_samples)
+        print(f'Exported the TFLite models to {args.output}')
+
+    if args.check_parity:
+        for name, value in check_parity(diffusion_model, decoder, args.output, args.parity_count,
+                                        args.parity_steps, method=args.method).items():
+            print(f'{name}: {value:.4f}')
+
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,247 @@
+"""A long-running local generation server, keeping the diffusion model and the decoder loaded.\n
+Requests are queued, and requests for the same sampling parameters are coalesced into a single batched
+reverse diffusion, until max_batch elements are collected or the oldest request waited max_wait seconds.
+Batches are padded to a power of two elements, so sampling is only traced for a few batch sizes.\n
+Run with `python -m voxelnn.generation_server diffusion.keras decoder.keras --group my-group`,
+then POST a JSON object to /generate:
+{"count": 4, "steps": 25, "method": "DPM++2M", "name": "Generated ({}/{})"}
+All fields are optional. The response is a JSON list of EntryDTO objects, as the Unity tool expects them.
+Tag and block names are read from the data saved with the models of the group (see model_storage)."""
+
+import argparse
+import json
+import os
+import queue
+import socketserver
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import keras
+import numpy as np
+from voxelnn import dataset_manipulation as dm
+from voxelnn import model_storage
+from voxelnn.coding.decoding import decode_to_blocks
+# register the custom objects needed to load the models
+import voxelnn.coding.custom_layers # pylint: disable=unused-import
+import voxelnn.diffusion.custom_layers # pylint: disable=unused-import
+import voxelnn.diffusion.diffusion_model # pylint: disable=unused-import
+
+
+@dataclass
+class GenerationRequest:
+    count: int
+    diffusion_steps: int
+    method: str
+    name_pattern: str = None
+    future: Future = field(default_factory=Future)
+    received: float = field(default_factory=time.monotonic)
+
+    @property
+    def key(self) -> tuple[int, str]:
+        return (self.diffusion_steps, self.method)
+
+
+def padded_batch_size(count: int) -> int:
+    """Round up to a power of two."""
+    return 1 << max(count - 1, 0).bit_length()
+
+
+class GenerationService:
+    """Runs requests on a single worker thread, coalescing requests with the same sampling parameters."""
+    def __init__(self, diffusion_model, decoder: keras.Model, tag_names: list[str], block_names: list[str],
+                 max_batch: int = 64, max_wait: float = 0.02, default_steps: int = 25, default_method: str = 'DDIM'):
+        self.diffusion_model = diffusion_model
+        self.decoder = decoder
+        self.tag_names = tag_names
+        self.block_names = block_names
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.default_steps = default_steps
+        self.default_method = default_method
+        self._queue = queue.Queue()
+        # requests taken from the queue, which didn't fit into the previous batch
+        self._pending = []
+        self._worker = threading.Thread(target=self._run, name='generation-worker', daemon=True)
+
+    def start(self):
+        self._worker.start()
+
+    def submit(self, count: int = 1, diffusion_steps: int = None, method: str = None, name_pattern: str = None
+               ) -> Future:
+        """Queue a request. The future resolves to a list of EntryDTO dictionaries, named by formatting
+        name_pattern with the index of the entry (from 1) and count."""
+        if not 1 <= count <= self.max_batch:
+            raise ValueError(f'Count has to be between 1 and {self.max_batch}, got {count}.')
+        if name_pattern is not None:
+            # checked here, so a malformed name fails this request, and not its whole batch
+            if not isinstance(name_pattern, str):
+                raise TypeError(f'Name has to be a string, got {type(name_pattern).__name__}.')
+            try:
+                name_pattern.format(1, count)
+            except (IndexError, KeyError, AttributeError, TypeError, ValueError) as e:
+                raise ValueError(f"Invalid name pattern '{name_pattern}': {e}") from e
+        request = GenerationRequest(count, diffusion_steps or self.default_steps, method or self.default_method,
+                                    name_pattern)
+        self._queue.put(request)
+        return request.future
+
+    def _take(self, timeout: float = None) -> GenerationRequest:
+        if self._pending:
+            return self._pending.pop(0)
+        return self._queue.get(timeout=timeout)
+
+    def _next_batch(self) -> list[GenerationRequest]:
+        """Wait for a request, then collect requests with the same key until the batch is full
+        or the first request waited max_wait."""
+        first = self._take()
+        batch, count = [first], first.count
+        deferred = []
+        while count < self.max_batch:
+            remaining = first.received + self.max_wait - time.monotonic()
+            if remaining <= 0 and not self._pending:
+                break
+            try:
+                request = self._take(timeout=max(remaining, 0))
+            except queue.Empty:
+                break
+            if request.key == first.key and count + request.count <= self.max_batch:
+                batch.append(request)
+                count += request.count
+            else:
+                deferred.append(request)
+        self._pending = deferred + self._pending
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                results = self._generate(batch)
+            except Exception as e: # pylint: disable=broad-exception-caught
+                for request in batch:
+                    request.future.set_exception(e)
+                continue
+            for request, result in zip(batch, results):
+                request.future.set_result(result)
+
+    def _generate(self, batch: list[GenerationRequest]) -> list[list[dict]]:
+        count = sum(request.count for request in batch)
+        diffusion_steps, method = batch[0].key
+        pred_data = self.diffusion_model.generate(diffusion_steps=diffusion_steps,
+                                                  element_count=padded_batch_size(count),
+                                                  method=method, history='none')[0]
+        blocks = decode_to_blocks(self.decoder, pred_data[:count])
+
+        results = []
+        start = 0
+        for request in batch:
+            name_pattern = request.name_pattern or 'Unnamed element ({}/{})'
+            results.append([dm.construct_entry_dto(name_pattern.format(i + 1, request.count),
+                                                   self.tag_names,
+                                                   np.zeros(len(self.tag_names)),
+                                                   self.block_names,
+                                                   blocks[start + i])
+                            for i in range(request.count)])
+            start += request.count
+        return results
+
+
+class GenerationRequestHandler(BaseHTTPRequestHandler):
+    service: GenerationService = None
+
+    def do_GET(self): # pylint: disable=invalid-name
+        if self.path != '/health':
+            self._respond(404, {'error': f"Unknown path '{self.path}'"})
+            return
+        self._respond(200, {'status': 'ok'})
+
+    def do_POST(self): # pylint: disable=invalid-name
+        if self.path != '/generate':
+            self._respond(404, {'error': f"Unknown path '{self.path}'"})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            body = json.loads(self.rfile.read(length) or b'{}')
+            future = self.service.submit(count=int(body.get('count', 1)),
+                                         diffusion_steps=body.get('steps'),
+                                         method=body.get('method'),
+                                         name_pattern=body.get('name'))
+        except (ValueError, TypeError) as e:
+            self._respond(400, {'error': str(e)})
+            return
+        try:
+            entries = future.result()
+        except Exception as e: # pylint: disable=broad-exception-caught
+            self._respond(500, {'error': str(e)})
+            return
+        self._respond(200, entries)
+
+    def _respond(self, status: int, content):
+        data = json.dumps(content).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return str(self.client_address[0]) if self.client_address else 'local'
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(service: GenerationService, host: str = '127.0.0.1', port: int = 8765, socket_path: str = None):
+    """Serve the service over HTTP on host:port, or on a Unix socket, if socket_path is given."""
+    handler = type('BoundGenerationRequestHandler', (GenerationRequestHandler,), {'service': service})
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = UnixHTTPServer(socket_path, handler)
+        print(f'Serving on {socket_path}')
+    else:
+        server = ThreadingHTTPServer((host, port), handler)
+        print(f'Serving on http://{host}:{port}')
+
+    service.start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def _main():
+    parser = argparse.ArgumentParser(description='Serve batched generation of decoded entries.')
+    parser.add_argument('diffusion_model', help='saved DiffusionModel (.keras)')
+    parser.add_argument('decoder', help='saved decoder (.keras)')
+    parser.add_argument('--group', required=True, help='model group, whose saved tag and block names are used')
+    parser.add_argument('--models-directory', default=model_storage.path_to_models)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--socket', default=None, help='serve on this Unix socket instead of host:port')
+    parser.add_argument('--max-batch', type=int, default=64)
+    parser.add_argument('--max-wait-ms', type=float, default=20.0)
+    parser.add_argument('--steps', type=int, default=25, help='default number of diffusion steps')
+    parser.add_argument('--method', default='DDIM', help='default sampling method')
+    args = parser.parse_args()
+
+    model_storage.path_to_models = args.models_directory
+    block_names, tag_names = model_storage.load_model_data(args.group)
+    service = GenerationService(keras.models.load_model(args.diffusion_model),
+                                keras.models.load_model(args.decoder),
+                                tag_names, block_names,
+                                max_batch=args.max_batch,
+                                max_wait=args.max_wait_ms / 1000,
+                                default_steps=args.steps,
+                                default_method=args.method)
+    serve(service, args.host, args.port, args.socket)
+
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,149 @@
+"""tf.data input pipelines, augmenting entries on the fly instead of materializing augmented copies."""
+
+import numpy as np
+import tensorflow as tf
+from voxelnn import dataset_manipulation as dm
+
+_READ_BATCH_SIZE = 256
+
+
+def _augment(entry: tf.Tensor, seed: tf.Tensor, flips: bool, rotations: bool, crop_shape: tuple,
+             spatial_rank: int = None) -> tf.Tensor:
+    """Randomly flip and rotate an entry around the vertical axis, so that 'up' stays 'up',
+    then randomly crop it. Entries are indexed (x, y[, z]) with y pointing up, as in the Unity tool.
+    Axes after the first spatial_rank axes (channels) are left untouched.
+    Takes a [2, 2] tensor of seeds for stateless random operations."""
+    rank = len(entry.shape)
+    spatial_rank = spatial_rank or rank
+    is3d = spatial_rank == 3
+    coins = tf.random.stateless_uniform([3], seed=seed[0], minval=0, maxval=2, dtype=tf.int32)
+    # independent seeds for the rotation and the crop
+    rotation_seed, crop_seed = tf.unstack(tf.random.experimental.stateless_split(seed[1], 2))
+
+    if flips:
+        entry = tf.cond(coins[0] == 1, lambda: tf.reverse(entry, axis=[0]), lambda: entry)
+        if is3d:
+            entry = tf.cond(coins[1] == 1, lambda: tf.reverse(entry, axis=[2]), lambda: entry)
+
+    if rotations and is3d:
+        size_x, _, size_z = entry.shape[:3]
+        if size_x == size_z:
+            # a quarter turn around the vertical axis
+            perm = [2, 1, 0, *range(3, rank)]
+            rotate = lambda e: tf.reverse(tf.transpose(e, perm=perm), axis=[0])
+            quarter_turns = tf.random.stateless_uniform([], seed=rotation_seed, minval=0, maxval=4, dtype=tf.int32)
+            entry = tf.switch_case(quarter_turns, [
+                lambda: entry,
+                lambda: rotate(entry),
+                lambda: rotate(rotate(entry)),
+                lambda: rotate(rotate(rotate(entry))),
+            ])
+        else:
+            # only half turns keep the shape
+            entry = tf.cond(coins[2] == 1, lambda: tf.reverse(entry, axis=[0, 2]), lambda: entry)
+
+    if crop_shape is not None:
+        entry = tf.image.stateless_random_crop(entry, size=(*crop_shape, *entry.shape[spatial_rank:]), seed=crop_seed)
+
+    return entry
+
+
+def _entries_dataset(arrays: list[np.ndarray], shuffle: bool, seed: int) -> tf.data.Dataset:
+    """Yield tuples of entries of equally long arrays, in (reshuffled every pass) random order.\n
+    Only indices are shuffled, entries are read from the arrays in batches, so the arrays may be memory maps."""
+    count = arrays[0].shape[0]
+    indices = tf.data.Dataset.range(count)
+    if shuffle:
+        indices = indices.shuffle(count, seed=seed, reshuffle_each_iteration=True)
+
+    def read(batch_indices):
+        # read in ascending order for locality in memory maps, then restore the shuffled order
+        order = np.argsort(batch_indices)
+        inverse = np.argsort(order)
+        return tuple(array[batch_indices[order]][inverse] for array in arrays)
+
+    def read_batch(batch_indices):
+        entries = tf.numpy_function(read, [batch_indices], [tf.as_dtype(a.dtype) for a in arrays], stateful=False)
+        return tuple(tf.ensure_shape(e, (None, *a.shape[1:])) for e, a in zip(entries, arrays))
+
+    return indices.batch(_READ_BATCH_SIZE).map(read_batch).unbatch()
+
+
+def build_dataset(blocks: np.ndarray | dict[tuple[int, ...], np.ndarray],
+                  batch_size: int,
+                  shuffle: bool = True,
+                  flips: bool = True,
+                  rotations: bool = True,
+                  crop_shape: tuple[int, ...] = None,
+                  drop_remainder: bool = False,
+                  repeat: bool = False,
+                  seed: int = None) -> tf.data.Dataset:
+    """Build a dataset of augmented batches of blocks, which can be passed straight to fit.\n
+    Entries are randomly flipped along horizontal axes and (3D only) rotated around the vertical axis,
+    then randomly cropped to crop_shape, if given. Augmentations run in parallel, and batches
+    are prefetched.\n
+    blocks may also be a bucketed dataset (see load_dataset); batches of different buckets
+    are then interleaved, every batch containing entries of a single shape."""
+    if isinstance(blocks, dict):
+        bucket_datasets = [build_dataset(array, batch_size, shuffle, flips, rotations, crop_shape,
+                                         drop_remainder, repeat=True, seed=seed)
+                           for array in blocks.values()]
+        weights = [array.shape[0] for array in blocks.values()]
+        weights = [w / sum(weights) for w in weights]
+        dataset = tf.data.Dataset.sample_from_datasets(bucket_datasets, weights=weights, seed=seed)
+        if not repeat:
+            dataset = dataset.take(dm.count_bucketed_batches(blocks, batch_size, drop_remainder))
+        return dataset.prefetch(tf.data.AUTOTUNE)
+
+    # unpack the 1-tuples
+    entries = _entries_dataset([blocks], shuffle, seed).map(lambda entry: entry)
+    if flips or rotations or crop_shape is not None:
+        seeds = tf.data.Dataset.random(seed=seed).batch(2).batch(2)
+        entries = tf.data.Dataset.zip(entries, seeds).map(
+            lambda entry, entry_seed: _augment(entry, entry_seed, flips, rotations, crop_shape),
+            num_parallel_calls=tf.data.AUTOTUNE)
+
+    dataset = entries.batch(batch_size, drop_remainder=drop_remainder)
+    if repeat:
+        dataset = dataset.repeat()
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+
+def build_latent_dataset(z_mean: np.ndarray,
+                         z_log_var: np.ndarray,
+                         batch_size: int,
+                         stddev: float = 1.0,
+                         shuffle: bool = True,
+                         flips: bool = True,
+                         rotations: bool = True,
+                         drop_remainder: bool = False,
+                         repeat: bool = False,
+                         seed: int = None) -> tf.data.Dataset:
+    """Build a dataset of batches of latents, sampled anew every time as
+    z_mean + exp(0.5 * z_log_var) * epsilon, with epsilon ~ N(0, stddev), like the Sampling layer does.
+    Pass the stddev of the encoder's Sampling layer (see latent_cache.sampling_stddev).\n
+    Augmentations are applied to the latent grids, which matches augmenting blocks only for encoders
+    working on each voxel separately (like the 1x1 convolution encoders)."""
+    spatial_rank = len(z_mean.shape) - 2
+    seeds = tf.data.Dataset.random(seed=seed).batch(2).batch(3)
+
+    def sample(mean, log_var, entry_seed):
+        if flips or rotations:
+            pair = _augment(tf.concat([mean, log_var], axis=-1), entry_seed[:2], flips, rotations,
+                            crop_shape=None, spatial_rank=spatial_rank)
+            mean, log_var = tf.split(pair, 2, axis=-1)
+        epsilon = tf.random.stateless_normal(tf.shape(mean), seed=entry_seed[2], stddev=stddev)
+        return mean + tf.exp(0.5 * log_var) * epsilon
+
+    entries = tf.data.Dataset.zip(_entries_dataset([z_mean, z_log_var], shuffle, seed), seeds)
+    entries = entries.map(lambda pair, entry_seed: sample(*pair, entry_seed), num_parallel_calls=tf.data.AUTOTUNE)
+
+    dataset = entries.batch(batch_size, drop_remainder=drop_remainder)
+    if repeat:
+        dataset = dataset.repeat()
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+
+def encode_dataset(dataset: tf.data.Dataset, encoder) -> tf.data.Dataset:
+    """Map a dataset of block batches to sampled latent batches (z), to train diffusion on."""
+    return dataset.map(lambda blocks: encoder(blocks, training=False)[2]).prefetch(tf.data.AUTOTUNE)
@@ -1,19 +1,17 @@
-"""Helper methods for working with notebooks."""
+"""Helper methods for working with notebooks.\n
+Plotting and widget libraries (and TensorFlow, for decoding) are imported by the functions using them,
+so importing this module stays cheap. Saving and loading models is in the headless voxelnn.model_storage."""
 
-import os
-import json
-from typing import Tuple
-import keras
-import ipywidgets as widgets
-import matplotlib as mpl
-import matplotlib.pyplot as plt
 import numpy as np
-import seaborn as sns
+# re-exported, for notebooks
+from voxelnn.model_storage import ( # pylint: disable=unused-import
+    load_model, load_model_data, prepare_io, save_model, save_model_data, training_checkpoint)
 
 
 OVERRIDDEN_COLORS = None
 
 def get_colors():
+    import matplotlib as mpl # pylint: disable=import-outside-toplevel
     colormap_name = 'tab10'
     global OVERRIDDEN_COLORS
     return OVERRIDDEN_COLORS or mpl.colormaps[colormap_name].colors
@@ -22,8 +20,9 @@ def set_color_scheme(block_names: list[str], color_dict: dict[str, tuple[float,
     global OVERRIDDEN_COLORS
     OVERRIDDEN_COLORS = [color_dict[name] for name in block_names]
 
-def result_json_widget(text: str, title = 'JSON to copy:') -> widgets.Widget:
+def result_json_widget(text: str, title = 'JSON to copy:') -> 'ipywidgets.Widget':
     """Use to display a text field to conveniently copy from."""
+    import ipywidgets as widgets # pylint: disable=import-outside-toplevel
     return widgets.Text(
         value=text,
         placeholder='a JSON string should be here...',
@@ -32,6 +31,7 @@ def result_json_widget(text: str, title = 'JSON to copy:') -> widgets.Widget:
 
 def plot_history(history):
     """Plot training history."""
+    import matplotlib.pyplot as plt # pylint: disable=import-outside-toplevel
     for k in history.history.keys():
         plt.plot(history.history[k])
         plt.title('history')
@@ -39,50 +39,12 @@ def plot_history(history):
     plt.legend(history.history.keys(), loc='upper left')
     plt.show()
 
-path_to_models = None
-
-def prepare_io(group: str):
-    global path_to_models
-    if path_to_models is None:
-        try:
-            from google.colab import drive
-            drive.mount('/content/drive/')
-            path_to_models = '/content/drive/MyDrive/voxel-nn/models/'
-        except Exception:
-            # probably not using google colab then
-            path_to_models = '../models/'
-    p = os.path.join(path_to_models, group)
-    if not os.path.exists(p):
-        os.makedirs(p)
-
-def save_model_data(group: str, blocks: list, tags: list):
-    prepare_io(group)
-    d = {
-        "Blocks": blocks,
-        "Tags": tags
-    }
-    with open(os.path.join(path_to_models, group, 'data.json'), 'w') as f:
-        json.dump(d, f)
-
-def load_model_data(group: str) -> Tuple[list, list]:
-    prepare_io(group)
-    with open(os.path.join(path_to_models, group, 'data.json'), 'r') as f:
-        data = json.load(f)
-        return list(data["Blocks"]), list(data["Tags"])
-
-def load_model(group: str, name: str, **kwargs):
-    prepare_io(group)
-    return keras.models.load_model(os.path.join(path_to_models, group, name), **kwargs)
-
-def save_model(group: str, name: str, model: keras.Model, **kwargs):
-    prepare_io(group)
-    model.save(os.path.join(path_to_models, group, name), **kwargs)
-
 def render_data_history_and_other_stuff(pred_data_history, decoder, index = 0, unit_per_image=4):
+    import matplotlib.pyplot as plt # pylint: disable=import-outside-toplevel
+    from voxelnn.coding.decoding import decode_to_blocks # pylint: disable=import-outside-toplevel
     iterations = pred_data_history.shape[0]
     f, axarr = plt.subplots(iterations, 2, sharex=True, sharey=True, figsize=(unit_per_image*2, unit_per_image*iterations))
-    decoded_history = decoder.predict(pred_data_history[:,index,...])
-    decoded_history = np.argmax(decoded_history, axis=-1).astype(int)
+    decoded_history = decode_to_blocks(decoder, pred_data_history[:,index,...])
     colors_local = np.array(get_colors())
     colored_history = colors_local[decoded_history]
     plt.tight_layout()
@@ -112,13 +74,13 @@ def render_data_history_and_other_stuff(pred_data_history, decoder, index = 0, u
         render_result(colored_history[iteration, ...], iteration, 1)
 
 def peek_encoding_and_decoding(blocks, encoder, decoder, samples=10):
+    import matplotlib.pyplot as plt # pylint: disable=import-outside-toplevel
+    from voxelnn.coding.decoding import decode_to_blocks # pylint: disable=import-outside-toplevel
     rows = samples
     columns = 5
     z_mean, _, z = encoder.predict(blocks[:samples,...])
-    z_mean_decoded = decoder.predict(z_mean)
-    z_decoded = decoder.predict(z)
-    z_mean_decoded = np.argmax(z_mean_decoded, axis=-1).astype(int)
-    z_decoded = np.argmax(z_decoded, axis=-1).astype(int)
+    z_mean_decoded = decode_to_blocks(decoder, z_mean)
+    z_decoded = decode_to_blocks(decoder, z)
     colors_local = np.array(get_colors())
     colored_z_mean_decoded = colors_local[z_mean_decoded]
     colored_z_decoded = colors_local[z_decoded]
@@ -156,6 +118,8 @@ def peek_encoding_and_decoding(blocks, encoder, decoder, samples=10):
 
 
 def preview_distribution_over_time(pred_data_history, pred_noise_history):
+    import matplotlib.pyplot as plt # pylint: disable=import-outside-toplevel
+    import seaborn as sns # pylint: disable=import-outside-toplevel
     iterations = pred_data_history.shape[0]
     size_per_unit = 4
     fig = plt.figure()
@@ -168,11 +132,12 @@ def preview_distribution_over_time(pred_data_history, pred_noise_history):
         axes[i, 1].set_title(f'Predicted noise for t={i+1}/{iterations}')
 
 def render_all_predictions(pred_data, decoder):
+    import matplotlib.pyplot as plt # pylint: disable=import-outside-toplevel
+    from voxelnn.coding.decoding import decode_to_blocks # pylint: disable=import-outside-toplevel
     entries = pred_data.shape[0]
     unit_per_image = 4
     f, axarr = plt.subplots(entries//2, 4, sharex=True, sharey=True, figsize=(unit_per_image*4, unit_per_image*(entries//2)))
-    decoded_data = decoder.predict(pred_data)
-    decoded_data = np.argmax(decoded_data, axis=-1).astype(int)
+    decoded_data = decode_to_blocks(decoder, pred_data)
     colors_local = np.array(get_colors())
     colored_data = colors_local[decoded_data]
     plt.tight_layout()
@@ -205,6 +170,7 @@ def render_all_predictions(pred_data, decoder):
         render_result(colored_data[i, ...], r, c2)
 
 def render_some_data(blocks):
+    import matplotlib.pyplot as plt # pylint: disable=import-outside-toplevel
     entries = blocks.shape[0]
     unit_per_image = 4
     f, axarr = plt.subplots(entries//4, 4, sharex=True, sharey=True, figsize=(unit_per_image*4, unit_per_image*(entries//4)))
@@ -225,6 +191,8 @@ def render_some_data(blocks):
         render_result(colored_data[i, ...], r, c)
 
 def peek_latent_space(encoder, decoder, blocks, block_type_count):
+    import matplotlib.pyplot as plt # pylint: disable=import-outside-toplevel
+    from voxelnn.coding.decoding import decode_to_blocks # pylint: disable=import-outside-toplevel
     _, _, z = encoder.predict(blocks)
     distinct_block = np.arange(block_type_count).reshape(block_type_count, 1, 1)
     poles, _, _ = encoder.predict(distinct_block)
@@ -240,8 +208,7 @@ def peek_latent_space(encoder, decoder, blocks, block_type_count):
     XY = np.meshgrid(x, y, indexing='xy')
     XY = np.array(XY).transpose()
     XY = XY.reshape((steps*steps, 1, 1, 2))
-    decoded = decoder.predict(XY)
-    real = np.argmax(decoded, axis=-1)
+    real = decode_to_blocks(decoder, XY, batch_size=4096)
     real = real.reshape(steps, steps)
     real = np.swapaxes(real, 0, 1)
     colors_local = np.array(get_colors())
@@ -0,0 +1,89 @@
+"""On-disk cache of encoded latent distributions, so diffusion training doesn't run the encoder."""
+
+import hashlib
+import json
+import os
+import shutil
+import keras
+import numpy as np
+from voxelnn.coding.custom_layers import Sampling
+
+_HASH_CHUNK_ENTRIES = 1024
+
+
+def sampling_stddev(encoder: keras.Model) -> float:
+    """Returns the stddev of the encoder's Sampling layer."""
+    for layer in encoder.layers:
+        if isinstance(layer, Sampling):
+            return layer.stddev
+    raise ValueError(f"Encoder '{encoder.name}' has no Sampling layer.")
+
+
+def fingerprint(encoder: keras.Model, blocks: np.ndarray) -> str:
+    """Hash the encoder's architecture and weights together with the dataset."""
+    h = hashlib.sha256()
+    h.update(json.dumps(encoder.get_config(), sort_keys=True, default=str).encode('utf-8'))
+    for weight in encoder.weights:
+        h.update(weight.path.encode('utf-8'))
+        h.update(np.ascontiguousarray(keras.ops.convert_to_numpy(weight)).tobytes())
+    h.update(f'{blocks.shape}{blocks.dtype.str}'.encode('utf-8'))
+    for start in range(0, blocks.shape[0], _HASH_CHUNK_ENTRIES):
+        h.update(np.ascontiguousarray(blocks[start:start + _HASH_CHUNK_ENTRIES]).tobytes())
+    return h.hexdigest()[:32]
+
+
+class LatentCache:
+    """Stores z_mean and z_log_var of every entry, keyed by a fingerprint of the encoder and the dataset.\n
+    Entries are encoded once per encoder version; later lookups return read-only memory maps.
+    Use input_pipeline.build_latent_dataset to sample training latents from them."""
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def _entry_directory(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def contains(self, key: str) -> bool:
+        return os.path.exists(os.path.join(self._entry_directory(key), 'meta.json'))
+
+    def load(self, key: str) -> tuple[np.ndarray, np.ndarray]:
+        """Returns memory maps of z_mean and z_log_var stored under the key."""
+        path = self._entry_directory(key)
+        return (np.load(os.path.join(path, 'z_mean.npy'), mmap_mode='r'),
+                np.load(os.path.join(path, 'z_log_var.npy'), mmap_mode='r'))
+
+    def get_or_encode(self, encoder: keras.Model, blocks: np.ndarray,
+                      batch_size: int = 256) -> tuple[np.ndarray, np.ndarray]:
+        """Returns cached z_mean and z_log_var for the blocks, encoding and storing them if needed."""
+        key = fingerprint(encoder, blocks)
+        if not self.contains(key):
+            self._encode(key, encoder, blocks, batch_size)
+        return self.load(key)
+
+    def _encode(self, key: str, encoder: keras.Model, blocks: np.ndarray, batch_size: int):
+        path = self._entry_directory(key)
+        temporary_path = path + '.partial'
+        shutil.rmtree(temporary_path, ignore_errors=True)
+        os.makedirs(temporary_path)
+
+        z_mean, z_log_var = None, None
+        for start in range(0, blocks.shape[0], batch_size):
+            batch_mean, batch_log_var, _ = encoder(np.asarray(blocks[start:start + batch_size]), training=False)
+            batch_mean = keras.ops.convert_to_numpy(batch_mean)
+            batch_log_var = keras.ops.convert_to_numpy(batch_log_var)
+            if z_mean is None:
+                shape = (blocks.shape[0], *batch_mean.shape[1:])
+                z_mean = np.lib.format.open_memmap(os.path.join(temporary_path, 'z_mean.npy'),
+                                                   mode='w+', dtype=batch_mean.dtype, shape=shape)
+                z_log_var = np.lib.format.open_memmap(os.path.join(temporary_path, 'z_log_var.npy'),
+                                                      mode='w+', dtype=batch_log_var.dtype, shape=shape)
+            z_mean[start:start + batch_size] = batch_mean
+            z_log_var[start:start + batch_size] = batch_log_var
+
+        z_mean.flush()
+        z_log_var.flush()
+        del z_mean, z_log_var
+        with open(os.path.join(temporary_path, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump({'encoder': encoder.name, 'entry_count': blocks.shape[0]}, f)
+
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(temporary_path, path)
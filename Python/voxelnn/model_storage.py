@@ -0,0 +1,52 @@
+"""Saving and loading models and model data in the models directory, shared by notebooks and scripts.\n
+Keras is only imported to load or save models, so reading model data doesn't start TensorFlow."""
+
+import os
+import json
+from typing import Tuple
+
+path_to_models = None
+
+def prepare_io(group: str):
+    global path_to_models
+    if path_to_models is None:
+        try:
+            from google.colab import drive # pylint: disable=import-outside-toplevel
+            drive.mount('/content/drive/')
+            path_to_models = '/content/drive/MyDrive/voxel-nn/models/'
+        except Exception:
+            # probably not using google colab then
+            path_to_models = '../models/'
+    p = os.path.join(path_to_models, group)
+    if not os.path.exists(p):
+        os.makedirs(p)
+
+def save_model_data(group: str, blocks: list, tags: list):
+    prepare_io(group)
+    d = {
+        "Blocks": blocks,
+        "Tags": tags
+    }
+    with open(os.path.join(path_to_models, group, 'data.json'), 'w') as f:
+        json.dump(d, f)
+
+def load_model_data(group: str) -> Tuple[list, list]:
+    prepare_io(group)
+    with open(os.path.join(path_to_models, group, 'data.json'), 'r') as f:
+        data = json.load(f)
+        return list(data["Blocks"]), list(data["Tags"])
+
+def load_model(group: str, name: str, **kwargs):
+    import keras # pylint: disable=import-outside-toplevel
+    prepare_io(group)
+    return keras.models.load_model(os.path.join(path_to_models, group, name), **kwargs)
+
+def save_model(group: str, name: str, model, **kwargs):
+    prepare_io(group)
+    model.save(os.path.join(path_to_models, group, name), **kwargs)
+
+def training_checkpoint(group: str, name: str, **kwargs):
+    """A callback checkpointing the training state into a directory of the group, resuming from it if it exists."""
+    from voxelnn.training_checkpoint import TrainingCheckpoint # pylint: disable=import-outside-toplevel
+    prepare_io(group)
+    return TrainingCheckpoint(os.path.join(path_to_models, group, name), **kwargs)
@@ -1,9 +1,15 @@
 """Helper functions for dealing with Tensorflow."""
 
+import json
+import os
+import keras
 import tensorflow as tf
 
-def maybe_use_tpu() -> bool:
-    """Use TPU if available, otherwise don't do anything."""
+PRECISIONS = ('float32', 'mixed_float16', 'mixed_bfloat16')
+STRATEGIES = ('auto', 'default', 'mirrored', 'multi_worker', 'tpu')
+
+def maybe_use_tpu() -> tf.distribute.TPUStrategy | None:
+    """Returns a TPU strategy if a TPU is available, otherwise None."""
     try:
         tpu = tf.distribute.cluster_resolver.TPUClusterResolver()  # TPU detection
         tf.config.experimental_connect_to_cluster(tpu)
@@ -11,7 +17,86 @@ def maybe_use_tpu() -> bool:
         tpu_strategy = tf.distribute.TPUStrategy(tpu)
         print('Running on TPU ', tpu.cluster_spec().as_dict()['worker'])
         print(tpu_strategy)
-        return True
+        return tpu_strategy
     except Exception as e: #pylint: disable=broad-except
         print(f"Something went wrong when trying to connect to a TPU: '{e}'.")
-        return False
+        return None
+
+def split_cpu(device_count: int):
+    """Split the CPU into device_count logical devices, to run data parallel training on a single machine
+    (or to test it). Has to be called before Tensorflow initializes its devices."""
+    cpu = tf.config.list_physical_devices('CPU')[0]
+    tf.config.set_logical_device_configuration(cpu, [tf.config.LogicalDeviceConfiguration()] * device_count)
+
+def set_threads(intra_op: int = None, inter_op: int = None):
+    """Set the number of threads used within an operation (intra_op) and to run operations in parallel
+    (inter_op), None or 0 leaving the choice to Tensorflow. Has to be called before Tensorflow initializes,
+    so several processes can share a machine without oversubscribing its cores."""
+    if intra_op:
+        tf.config.threading.set_intra_op_parallelism_threads(intra_op)
+    if inter_op:
+        tf.config.threading.set_inter_op_parallelism_threads(inter_op)
+    print(f'Using {tf.config.threading.get_intra_op_parallelism_threads() or "default"} intra-op and '
+          f'{tf.config.threading.get_inter_op_parallelism_threads() or "default"} inter-op threads')
+
+def set_local_cluster(worker_count: int, task_index: int, base_port: int = 12345):
+    """Set TF_CONFIG for a cluster of worker_count processes on this machine, this process being task_index,
+    for MultiWorkerMirroredStrategy. Every process runs the same training script with its own task_index."""
+    os.environ['TF_CONFIG'] = json.dumps({
+        'cluster': {'worker': [f'localhost:{base_port + i}' for i in range(worker_count)]},
+        'task': {'type': 'worker', 'index': task_index},
+    })
+
+def get_strategy(kind: str = 'auto', devices: list[str] = None) -> tf.distribute.Strategy:
+    """Returns a distribution strategy; build and compile models in its scope, then fit as usual:
+    * 'tpu' - TPUStrategy,
+    * 'multi_worker' - MultiWorkerMirroredStrategy, for processes described by TF_CONFIG (see set_local_cluster),
+    * 'mirrored' - MirroredStrategy over devices, by default all GPUs, or all logical CPUs (see split_cpu),
+    * 'default' - no distribution,
+    * 'auto' - a TPU if available, then multi_worker if TF_CONFIG is set, then mirrored for several devices.\n
+    Trainers average losses over the global batch, so batch sizes passed to fit are global batch sizes."""
+    if kind not in STRATEGIES:
+        raise ValueError(f"Unknown strategy '{kind}', expected one of {STRATEGIES}.")
+
+    if kind in ('auto', 'tpu'):
+        strategy = maybe_use_tpu()
+        if strategy is not None:
+            return strategy
+        if kind == 'tpu':
+            raise ValueError('No TPU available.')
+        if 'TF_CONFIG' in os.environ:
+            kind = 'multi_worker'
+        else:
+            devices = devices or _local_devices()
+            kind = 'mirrored' if len(devices) > 1 else 'default'
+
+    if kind == 'multi_worker':
+        strategy = tf.distribute.MultiWorkerMirroredStrategy()
+    elif kind == 'mirrored':
+        strategy = tf.distribute.MirroredStrategy(devices or _local_devices())
+    else:
+        strategy = tf.distribute.get_strategy()
+    print(f'Using {type(strategy).__name__} with {strategy.num_replicas_in_sync} replicas')
+    return strategy
+
+def _local_devices() -> list[str]:
+    gpus = tf.config.list_logical_devices('GPU')
+    return [d.name for d in (gpus or tf.config.list_logical_devices('CPU'))]
+
+def scale_loss_for_replicas(loss: tf.Tensor) -> tf.Tensor:
+    """Scale a loss averaged over the batch of a replica, so that gradients, which are summed over replicas,
+    are averaged over the global batch."""
+    return loss / tf.distribute.get_strategy().num_replicas_in_sync
+
+def set_precision(precision: str = 'float32'):
+    """Set the dtype policy of models built afterwards: 'float32', 'mixed_float16' or 'mixed_bfloat16'.\n
+    With mixed precision, layers compute in float16/bfloat16, while weights (and the EMA weights of
+    DiffusionModel) stay in float32. Trainers compute their losses in float32, and with 'mixed_float16'
+    compile wraps the optimizer in a LossScaleOptimizer. bfloat16 needs no loss scaling, and is the one
+    to use on CPUs supporting AVX512_BF16/AMX.\n
+    Build (or load) the encoder, decoder and U-Net after calling this. Pass jit_compile=True to compile
+    to also compile train steps with XLA."""
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision '{precision}', expected one of {PRECISIONS}.")
+    keras.config.set_dtype_policy(precision)
+    print(f'Using {precision} precision')
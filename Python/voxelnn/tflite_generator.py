@@ -0,0 +1,77 @@
+"""Generation with the TFLite models written by voxelnn.export, needing only NumPy and a TFLite interpreter
+(tensorflow, ai-edge-litert or tflite-runtime), not the training code."""
+
+import json
+import os
+import numpy as np
+
+CONFIG_FILE = 'tflite_generator.json'
+UNET_FILE = 'unet.tflite'
+DECODER_FILE = 'decoder.tflite'
+
+
+def _interpreter(path: str):
+    """Load a TFLite model with the first interpreter available."""
+    try:
+        from ai_edge_litert.interpreter import Interpreter # pylint: disable=import-outside-toplevel
+    except ImportError:
+        try:
+            from tflite_runtime.interpreter import Interpreter # pylint: disable=import-outside-toplevel
+        except ImportError:
+            import tensorflow as tf # pylint: disable=import-outside-toplevel
+            Interpreter = tf.lite.Interpreter
+    return Interpreter(model_path=path)
+
+
+class TFLiteGenerator:
+    """Runs DDIM reverse diffusion with the exported U-Net, then decodes the latents to block IDs,
+    same as the float model with method='DDIM'.\n
+    The initial noise comes from NumPy's generator, so for a seed the result differs from the SavedModel's;
+    pass initial_noise to compare both on the same starting point."""
+    def __init__(self, directory: str):
+        with open(os.path.join(directory, CONFIG_FILE), 'r', encoding='utf-8') as file:
+            config = json.load(file)
+        self.data_shape = tuple(config['data_shape'])
+        self.min_signal_rate = config['min_signal_rate']
+        self.max_signal_rate = config['max_signal_rate']
+        self.mean = np.array(config['mean'], dtype=np.float32)
+        self.variance = np.array(config['variance'], dtype=np.float32)
+        self.block_dtype = np.dtype(config['block_dtype'])
+        self.unet = _interpreter(os.path.join(directory, UNET_FILE)).get_signature_runner('serve')
+        self.decoder = _interpreter(os.path.join(directory, DECODER_FILE)).get_signature_runner('serve')
+
+    def _signal_powers(self, diffusion_times: float) -> np.float32:
+        """The cosine schedule of DiffusionModel."""
+        start_angle = np.arccos(np.float32(self.max_signal_rate))
+        end_angle = np.arccos(np.float32(self.min_signal_rate))
+        return np.cos(start_angle + np.float32(diffusion_times) * (end_angle - start_angle)) ** 2
+
+    def generate_latents(self, count: int = 1, steps: int = 25, seed: int = None,
+                         initial_noise: np.ndarray = None) -> np.ndarray:
+        """Returns denormalized latents of count elements."""
+        if initial_noise is None:
+            initial_noise = np.random.default_rng(seed).standard_normal((count, *self.data_shape))
+        noisy_data = np.asarray(initial_noise, dtype=np.float32)
+        pred_data = np.zeros_like(noisy_data)
+        step_size = 1.0 / steps
+        for step in range(steps):
+            signal_powers = self._signal_powers(1.0 - step * step_size)
+            noise_powers = 1 - signal_powers
+            next_signal_powers = self._signal_powers(1.0 - (step + 1) * step_size)
+            next_noise_powers = 1 - next_signal_powers
+
+            times = np.full([noisy_data.shape[0]], noise_powers, dtype=np.float32)
+            pred_noises = next(iter(self.unet(noisy_data=noisy_data, noise_powers=times).values()))
+            pred_data = (noisy_data - noise_powers ** 0.5 * pred_noises) / signal_powers ** 0.5
+            noisy_data = next_signal_powers ** 0.5 * pred_data + next_noise_powers ** 0.5 * pred_noises
+        return self.mean + pred_data * self.variance ** 0.5
+
+    def decode(self, latents: np.ndarray) -> np.ndarray:
+        """Decode latents to block IDs."""
+        blocks = next(iter(self.decoder(latents=np.asarray(latents, dtype=np.float32)).values()))
+        return blocks.astype(self.block_dtype)
+
+    def generate(self, count: int = 1, steps: int = 25, seed: int = None,
+                 initial_noise: np.ndarray = None) -> np.ndarray:
+        """Returns block IDs of count generated elements."""
+        return self.decode(self.generate_latents(count, steps, seed, initial_noise))
@@ -0,0 +1,114 @@
+"""Checkpointing of the training state, so long training runs can resume after a crash or a preemption."""
+
+import signal
+import threading
+import keras
+import tensorflow as tf
+
+
+class TrainingCheckpoint(keras.callbacks.Callback):
+    """Periodically checkpoints the training state with tf.train.CheckpointManager: all variables of the model
+    (for a DiffusionModel the network, the EMA network and the normalizer), the optimizer variables (slots and
+    the iteration count), the random generators and the epoch.\n
+    Checkpoints are written asynchronously: variables are copied from the devices, then written to files in
+    a background thread, while training continues. The newest max_to_keep checkpoints are kept, older ones
+    are deleted, except for one every keep_every_hours, if given.\n
+    Training resumes from the latest checkpoint in the directory: fit with this callback restores the state
+    and continues from the epoch after the checkpointed one. On SIGTERM (preemption), the state is checkpointed
+    after the current batch and training stops; the interrupted epoch is repeated on resume.\n
+    Build the model (for a DiffusionModel, learn the data distribution) before fitting or restoring,
+    as variables are matched with the checkpoint by their order."""
+    def __init__(self, directory: str, every_epochs: int = 1, max_to_keep: int = 3, keep_every_hours: float = None,
+                 asynchronous: bool = True, handle_sigterm: bool = True):
+        super().__init__()
+        self.directory = directory
+        self.every_epochs = every_epochs
+        self.max_to_keep = max_to_keep
+        self.keep_every_hours = keep_every_hours
+        self.asynchronous = asynchronous
+        self.handle_sigterm = handle_sigterm
+        self._epoch = tf.Variable(0, dtype=tf.int64, trainable=False, name='epoch')
+        self._checkpoint = None
+        self._manager = None
+        self._checkpointed_model = None
+        self._current_epoch = 0
+        self._preempted = threading.Event()
+        self._previous_sigterm_handler = None
+
+    def _get_manager(self, model: keras.Model) -> tf.train.CheckpointManager:
+        if self._checkpointed_model is not model:
+            if model.optimizer is not None and not model.optimizer.built:
+                # optimizer variables have to exist to be restored
+                with model.distribute_strategy.scope():
+                    model.optimizer.build(model.trainable_variables)
+
+            random_generators = {'global': tf.random.get_global_generator()}
+            if hasattr(model, 'noise_generator'):
+                random_generators['noise'] = model.noise_generator
+            optimizer_variables = model.optimizer.variables if model.optimizer is not None else []
+            # the underlying tf.Variables, Keras variables can't be copied for an asynchronous checkpoint twice
+            self._checkpoint = tf.train.Checkpoint(model=[variable.value for variable in model.variables],
+                                                   optimizer=[variable.value for variable in optimizer_variables],
+                                                   random=random_generators,
+                                                   epoch=self._epoch)
+            self._manager = tf.train.CheckpointManager(self._checkpoint, self.directory,
+                                                       max_to_keep=self.max_to_keep,
+                                                       keep_checkpoint_every_n_hours=self.keep_every_hours)
+            self._checkpointed_model = model
+        return self._manager
+
+    def restore(self, model: keras.Model) -> int:
+        """Restore the latest checkpoint into a built model, if there is one.
+        Returns the epoch to continue training from (0 without a checkpoint)."""
+        manager = self._get_manager(model)
+        if manager.latest_checkpoint is None:
+            return 0
+
+        self._checkpoint.sync()
+        self._checkpoint.restore(manager.latest_checkpoint).assert_consumed()
+        # layers keeping state computed from their variables (Normalization's mean and variance)
+        for layer in model._flatten_layers(): # pylint: disable=protected-access
+            if hasattr(layer, 'finalize_state') and layer.built:
+                layer.finalize_state()
+        print(f'TrainingCheckpoint: Restored {manager.latest_checkpoint}, epoch {int(self._epoch.numpy())}')
+        return int(self._epoch.numpy())
+
+    def save(self, epoch: int) -> str:
+        """Checkpoint the state of the model, to continue training from epoch.
+        Checkpoints are numbered by the epoch, a checkpoint of a preempted epoch is replaced when it ends."""
+        self._epoch.assign(epoch)
+        options = tf.train.CheckpointOptions(experimental_enable_async_checkpoint=self.asynchronous)
+        return self._get_manager(self.model).save(checkpoint_number=epoch, options=options)
+
+    def on_train_begin(self, logs=None):
+        self._preempted.clear()
+        if self._checkpointed_model is not self.model:
+            # resume the first time the model is trained, later fits continue with the state in memory;
+            # same as keras.callbacks.BackupAndRestore, fit starts from the model's _initial_epoch
+            self.model._initial_epoch = self.restore(self.model) # pylint: disable=protected-access
+        if self.handle_sigterm and threading.current_thread() is threading.main_thread():
+            self._previous_sigterm_handler = signal.signal(signal.SIGTERM, self._on_sigterm)
+
+    def _on_sigterm(self, signum, frame): # pylint: disable=unused-argument
+        self._preempted.set()
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._current_epoch = epoch
+
+    def on_train_batch_end(self, batch, logs=None):
+        if self._preempted.is_set() and not self.model.stop_training:
+            path = self.save(self._current_epoch)
+            self._checkpoint.sync()
+            print(f'TrainingCheckpoint: Preempted, saved {path}')
+            self.model.stop_training = True
+
+    def on_epoch_end(self, epoch, logs=None):
+        if (epoch + 1) % self.every_epochs == 0 and not self._preempted.is_set():
+            self.save(epoch + 1)
+
+    def on_train_end(self, logs=None):
+        if self._checkpoint is not None:
+            self._checkpoint.sync()
+        if self._previous_sigterm_handler is not None:
+            signal.signal(signal.SIGTERM, self._previous_sigterm_handler)
+            self._previous_sigterm_handler = None